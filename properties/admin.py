@@ -1,5 +1,6 @@
 from django.contrib import admin
 from properties.models import *
+from properties.signals import homes_updated
 from django.contrib.gis.db import models as gis_models
 from django.contrib.gis.forms.widgets import OSMWidget
 
@@ -48,6 +49,11 @@ class OwnershipInLine(admin.StackedInline):
     can_delete = False
 
 
+class HomeVisitAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'home', 'visited_at')
+    readonly_fields = ('user', 'home', 'visited_at')
+
+
 class HomeAdmin(admin.ModelAdmin):
     # fields = '__all__'
     list_display = ('id', 'owner', 'price', 'type', 'state', 'is_pending')
@@ -56,15 +62,18 @@ class HomeAdmin(admin.ModelAdmin):
     radio_fields = {"state": admin.VERTICAL, "type": admin.VERTICAL}
     inlines = [ApartmentInLine, HouseInLine, OwnershipInLine,
                ImageInLine, FeaturesInLine]
-    readonly_fields = ('visited_by',)
 
     def make_posted(self, request, queryset):
+        home_ids = list(queryset.values_list('id', flat=True))  # the changelist filter may not match them after
         queryset.update(is_pending=False)
+        homes_updated(home_ids)
 
     make_posted.short_description = "Post selected homes"
 
     def make_pending(self, request, queryset):
+        home_ids = list(queryset.values_list('id', flat=True))  # the changelist filter may not match them after
         queryset.update(is_pending=True)
+        homes_updated(home_ids)
 
     actions = [make_posted, make_pending]
     make_pending.short_description = "Pend selected homes"
@@ -91,3 +100,4 @@ admin.site.register(LivingSpace)
 admin.site.register(Features)
 admin.site.register(Image)
 admin.site.register(Ownership)
+admin.site.register(HomeVisit, HomeVisitAdmin)
@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class PropertiesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'properties'
+
+    def ready(self):
+        import properties.signals  # noqa: F401
+        if getattr(settings, 'PRICE_MODELS_PRELOAD', False):
+            from properties.utils.price_prediction import price_models
+            price_models()
@@ -0,0 +1,81 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+logger = logging.getLogger(__name__)
+
+
+class FailSafeCache:
+    """
+    The default cache, with the errors of its backend (e.g. the cache server being down) logged and taken as
+    misses, so that the searches fall back to the database instead of failing. incr() still raises the
+    ValueError of a missing key.
+    """
+
+    def call(self, method, default, *args):
+        try:
+            return getattr(cache, method)(*args)
+        except Exception as e:
+            if method == 'incr' and isinstance(e, ValueError):
+                raise
+            logger.warning('The cache failed on %s: %r', method, e)
+            return default
+
+    def get(self, key, default=None):
+        return self.call('get', default, key, default)
+
+    def get_many(self, keys):
+        return self.call('get_many', {}, keys)
+
+    def set(self, key, value, timeout):
+        self.call('set', None, key, value, timeout)
+
+    def set_many(self, data, timeout):
+        self.call('set_many', None, data, timeout)
+
+    def add(self, key, value, timeout):
+        return self.call('add', False, key, value, timeout)
+
+    def incr(self, key):
+        """ The incremented value, or None when the cache failed """
+        return self.call('incr', None, key)
+
+    def delete_many(self, keys):
+        self.call('delete_many', None, keys)
+
+
+safe_cache = FailSafeCache()
+
+
+def cache_is_shared():
+    """
+    Whether every worker process sees the same cache. The cached pages, card fragments, tiles and the ETags of
+    the searches expire by changing keys of the cache, which the other workers would not see in a per process
+    one, so they are only used with a shared backend. CACHE_IS_SHARED overrides the guess, e.g. for a server
+    running a single process.
+    """
+    shared = getattr(settings, 'CACHE_IS_SHARED', None)
+    if shared is not None:
+        return shared
+    return not isinstance(caches[DEFAULT_CACHE_ALIAS], (LocMemCache, DummyCache))
+
+
+def generations(keys):
+    """
+    The values of the generation counters `keys`. A counter missing from the cache, never bumped or evicted,
+    starts at the current time rather than 0, so pages cached under an evicted generation never come back.
+    While the cache fails, every call gets new generations, which nothing is cached under.
+    """
+    values = safe_cache.get_many(keys)
+    missing = [key for key in keys if key not in values]
+    if missing:
+        generation = time.time_ns()
+        for key in missing:
+            safe_cache.add(key, generation, None)
+        added = safe_cache.get_many(missing)
+        values.update({key: added.get(key, generation) for key in missing})
+    return [values[key] for key in keys]
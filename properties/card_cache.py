@@ -0,0 +1,217 @@
+import json
+import time
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from properties.caching import cache_is_shared, generations, safe_cache
+from properties.filters import FILTER_PARAMS, normalized_filter_key, search_sort
+from properties.models import HOME_TYPES_OPTIONS, Home
+from properties.search_index import search_index
+from properties.serializers import HomeCardsSerializer
+
+HOME_TYPES = [home_type for home_type, _ in HOME_TYPES_OPTIONS]
+CITY_FILTERS_COUNT_KEY = 'cards:city-filters'
+MAX_CITY_FILTERS = 1000
+VIEWS_GENERATION_KEY = 'cards:generation:views'
+VIEWS_WRITTEN_KEY = 'cards:views-written'
+HITS_KEY = 'cards:hits'
+MISSES_KEY = 'cards:misses'
+
+
+def type_generation_key(home_type):
+    return f'cards:generation:type:{home_type}'
+
+
+def city_generation_key(city):
+    return f'cards:generation:city:{quote(city)}'
+
+
+def city_filter_key(city):
+    return f'cards:city-filter:{quote(city)}'
+
+
+def city_filter_slot_key(slot):
+    return f'cards:city-filter-slot:{slot}'
+
+
+def normalize_city(city):
+    return (city or '').strip().lower()
+
+
+def generation_keys(params):
+    """
+    The generation counters a search depends on. A city search only changes when a home in a matching city
+    does; any other search changes when a home of one of the types it covers does.
+    """
+    city = normalize_city(params.get('city'))
+    if city:
+        return [city_generation_key(city)]
+    home_type = (params.get('type') or '').strip().upper()
+    if home_type in HOME_TYPES:
+        return [type_generation_key(home_type)]
+    return [type_generation_key(home_type) for home_type in HOME_TYPES]
+
+
+def invalidate_cards(cities, types):
+    """ Expire the cached searches that can contain a home of one of these cities or types """
+    keys = [type_generation_key(home_type) for home_type in set(types)]
+    cities = {normalize_city(city) for city in cities if city}
+    if cities:
+        # city searches match with icontains, so "nab" has to expire with "nablus"
+        for city_filter in registered_city_filters():
+            if any(city_filter in city for city in cities):
+                keys.append(city_generation_key(city_filter))
+    generation = time.time_ns()
+    safe_cache.set_many({key: generation for key in keys}, None)
+
+
+def invalidate_views():
+    """ Note that views were written, views_generation() expires the searches showing them """
+    safe_cache.set(VIEWS_WRITTEN_KEY, time.time_ns(), None)
+
+
+def views_generation():
+    """
+    The generation of the views shown by every search, and of the order of the pages sorted by views. It only
+    moves when views were written since it last did, and at most every CARDS_VIEWS_INTERVAL seconds, so the
+    views of the cached searches are at most that stale while their caches survive steady traffic.
+    """
+    generation, = generations([VIEWS_GENERATION_KEY])
+    written = safe_cache.get(VIEWS_WRITTEN_KEY, 0)
+    now = time.time_ns()
+    if written > generation and now - generation >= getattr(settings, 'CARDS_VIEWS_INTERVAL', 60) * 10 ** 9:
+        generation = now
+        safe_cache.set(VIEWS_GENERATION_KEY, generation, None)
+    return generation
+
+
+def registered_city_filters():
+    count = min(safe_cache.get(CITY_FILTERS_COUNT_KEY, 0), MAX_CITY_FILTERS)
+    return set(safe_cache.get_many([city_filter_slot_key(slot) for slot in range(count)]).values())
+
+
+def register_city_filter(city):
+    """
+    Track the city filter so that invalidate_cards() expires its searches. The last MAX_CITY_FILTERS filters
+    registered are kept in a ring of slots, taken in turn from an atomic counter. A filter whose slot was
+    taken over registers again with a new generation, as the changes in between were not tracked. False when
+    the cache fails.
+    """
+    slot = safe_cache.get(city_filter_key(city))
+    if slot is not None and safe_cache.get(city_filter_slot_key(slot)) == city:
+        return True
+    safe_cache.add(CITY_FILTERS_COUNT_KEY, 0, None)
+    count = safe_cache.incr(CITY_FILTERS_COUNT_KEY)
+    if count is None:
+        return False
+    slot = (count - 1) % MAX_CITY_FILTERS
+    # the slot first, so the filter is expired as soon as another reader can find it registered
+    safe_cache.set(city_filter_slot_key(slot), city, None)
+    safe_cache.set(city_filter_key(city), slot, None)
+    safe_cache.set(city_generation_key(city), time.time_ns(), None)
+    return True
+
+
+def count(key):
+    try:
+        safe_cache.incr(key)
+    except ValueError:
+        safe_cache.set(key, 1, None)
+
+
+def cards_generation(params):
+    """ The current generations the search for `params` depends on, or None when its city cannot be tracked """
+    city = normalize_city(params.get('city'))
+    if city and not register_city_filter(city):
+        return None
+    generation = '.'.join(str(value) for value in generations(generation_keys(params)))
+    index = search_index()
+    if index is not None:
+        # the index catches up with the changes a moment after the generations are bumped
+        generation += f'.{index.change_token()}'
+    return generation
+
+
+def cards_etag(params):
+    """
+    A weak ETag of the houses search response for `params`, from the canonical parameters and their
+    generations, without touching the database. None when the generations cannot tell a change, or when the
+    workers do not share them.
+    """
+    if not cache_is_shared():
+        return None
+    generation = cards_generation(params)
+    if generation is None:
+        return None
+    search = normalized_filter_key(params, FILTER_PARAMS + ('sort', 'cursor', 'limit', 'stream'))
+    envelope = 'e' if 'cursor' in params else 'l'  # the cards are wrapped when a cursor is passed, even empty
+    # weak, as the cards show views up to CARDS_VIEWS_INTERVAL seconds newer than the generation tells
+    return f'W/"{search}-{envelope}-{generation}-{views_generation()}"'
+
+
+def cached_cards_page(params, limit, build_page):
+    """
+    The (home ids, next cursor) page of the houses search for `params`, built by `build_page(params, limit)`
+    and cached under the canonical search parameters and the generations they depend on.
+    """
+    if not cache_is_shared():
+        return build_page(params, limit)
+    generation = cards_generation(params)
+    if generation is None:
+        return build_page(params, limit)
+    if search_sort(params) == 'views':
+        generation += f'.{views_generation()}'
+    search = normalized_filter_key(params, FILTER_PARAMS + ('sort', 'cursor'))
+    key = f'cards:{search}:{limit}:{generation}'
+    page = safe_cache.get(key)
+    if page is None:
+        count(MISSES_KEY)
+        page = build_page(params, limit)
+        safe_cache.set(key, page, getattr(settings, 'CARDS_CACHE_TIMEOUT', 5 * 60))
+    else:
+        count(HITS_KEY)
+    return page
+
+
+def card_cache_stats():
+    counts = safe_cache.get_many([HITS_KEY, MISSES_KEY])
+    hits, misses = counts.get(HITS_KEY, 0), counts.get(MISSES_KEY, 0)
+    return {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else None}
+
+
+def card_fragment_key(home_id):
+    return f'cards:fragment:{home_id}'
+
+
+def build_card_fragments(home_ids):
+    homes = Home.objects.filter(pk__in=home_ids).for_cards()
+    return {card_fragment_key(card['id']): json.dumps(card, cls=DjangoJSONEncoder).encode()
+            for card in HomeCardsSerializer(homes, many=True).data}
+
+
+def invalidate_card_fragments(home_ids):
+    safe_cache.delete_many([card_fragment_key(home_id) for home_id in home_ids])
+
+
+def card_fragments(home_ids):
+    """
+    The pre-encoded JSON cards of the given homes, in order. Only the missing fragments are serialized, in one
+    batch, and cached until the home or its related rows change.
+    """
+    if not cache_is_shared():
+        built = build_card_fragments(home_ids)
+        return [built[key] for key in map(card_fragment_key, home_ids) if key in built]
+    keys = [card_fragment_key(home_id) for home_id in home_ids]
+    fragments = safe_cache.get_many(keys)
+    missing = [home_id for home_id, key in zip(home_ids, keys) if key not in fragments]
+    if missing:
+        built = build_card_fragments(missing)
+        safe_cache.set_many(built, getattr(settings, 'CARD_FRAGMENTS_CACHE_TIMEOUT', 24 * 60 * 60))
+        fragments.update(built)
+    return [fragments[key] for key in keys if key in fragments]
+
+
+def cards_json(home_ids):
+    return b'[' + b', '.join(card_fragments(home_ids)) + b']'
@@ -0,0 +1,41 @@
+from django.contrib.gis.db.models import Collect
+from django.contrib.gis.db.models.functions import Centroid, SnapToGrid
+from django.db.models import Count, Min, Max
+
+from properties.geo import location_bbox, parse_bbox
+
+GRID_CELLS_PER_TILE = 4  # a 256px map tile is split into cells of 64px, the size of a marker
+MAX_ZOOM = 22
+
+
+def cluster_homes(queryset, bbox, zoom):
+    """
+    Group the homes of `queryset` inside the `bbox` viewport into grid cells sized for the map `zoom` level,
+    in a single aggregate query. The number of clusters depends on the viewport, not on how many homes are in it.
+    """
+    zoom = int(zoom)
+    if zoom < 0 or zoom > MAX_ZOOM:
+        raise ValueError(f'Invalid zoom: {zoom}, should be between 0 and {MAX_ZOOM}')
+    cell_size = 360 / (GRID_CELLS_PER_TILE * 2 ** zoom)
+
+    clusters = queryset.filter(location__coordinates__within=location_bbox(*parse_bbox(bbox))) \
+        .order_by() \
+        .annotate(cell=SnapToGrid('location__coordinates', cell_size)) \
+        .values('cell') \
+        .annotate(count=Count('id'), center=Centroid(Collect('location__coordinates')),
+                  min_price=Min('price'), max_price=Max('price'), home_id=Min('id'))
+
+    data = []
+    for cluster in clusters:
+        center = cluster['center']
+        marker = {
+            'count': cluster['count'],
+            'lat': center.x,  # the same axis order as LocationSerializer
+            'lng': center.y,
+            'min_price': cluster['min_price'],
+            'max_price': cluster['max_price'],
+        }
+        if cluster['count'] == 1:
+            marker['id'] = cluster['home_id']
+        data.append(marker)
+    return data
@@ -0,0 +1,72 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+
+from properties.caching import safe_cache
+from properties.filters import filter_homes, normalized_filter_key
+
+MAX_BEDROOMS_BUCKET = 5  # like the bedrooms filter, 5 means 5 or more
+PRICE_BUCKETS = [0, 50000, 100000, 200000, 500000, 1000000]  # lower bounds of the price buckets
+FACETS = ('city', 'type', 'state', 'bedrooms', 'price')
+
+
+def facet_counts(queryset):
+    """
+    Count the homes of `queryset` per city, type, state, bedrooms bucket and price bucket in one pass over them,
+    with GROUPING SETS.
+    """
+    homes = queryset.order_by() \
+        .annotate(facet_city=F('location__city'), facet_bedrooms=F('living_space__bedrooms')) \
+        .values('facet_city', 'type', 'state', 'facet_bedrooms', 'price')
+    homes_sql, homes_params = homes.query.sql_with_params()
+    sql = f'''
+        SELECT city, type, state, bedrooms, price_bucket,
+               GROUPING(city), GROUPING(type), GROUPING(state), GROUPING(bedrooms), GROUPING(price_bucket),
+               COUNT(*)
+        FROM (
+            SELECT facet_city AS city, type, state, LEAST(facet_bedrooms, %s) AS bedrooms,
+                   width_bucket(price, %s) AS price_bucket
+            FROM ({homes_sql}) AS homes
+        ) AS buckets
+        GROUP BY GROUPING SETS ((city), (type), (state), (bedrooms), (price_bucket), ())
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [MAX_BEDROOMS_BUCKET, PRICE_BUCKETS, *homes_params])
+        rows = cursor.fetchall()
+
+    facets = {'total': 0}
+    facets.update({facet: [] for facet in FACETS})
+    for row in rows:
+        values, grouped, count = row[:5], row[5:10], row[10]
+        if all(grouped):  # the () grouping set
+            facets['total'] = count
+            continue
+        index = grouped.index(0)
+        facet, value = FACETS[index], values[index]
+        if value is None:  # homes without a location or living space
+            continue
+        if facet == 'price':
+            upper = PRICE_BUCKETS[value] if value < len(PRICE_BUCKETS) else None
+            facets[facet].append({'min': PRICE_BUCKETS[value - 1], 'max': upper, 'count': count})
+        elif facet == 'bedrooms':
+            label = f'{value}+' if value == MAX_BEDROOMS_BUCKET else str(value)
+            facets[facet].append({'value': label, 'count': count})
+        else:
+            facets[facet].append({'value': value, 'count': count})
+    for facet in FACETS:
+        key = 'min' if facet == 'price' else 'value'
+        facets[facet].sort(key=lambda item: item[key])
+    return facets
+
+
+def cached_facet_counts(params):
+    """ facet_counts() of the search parameters, cached for FACETS_CACHE_TIMEOUT seconds (0 disables it) """
+    timeout = getattr(settings, 'FACETS_CACHE_TIMEOUT', 30)
+    if not timeout:
+        return facet_counts(filter_homes(params))
+    key = f'facets:{normalized_filter_key(params)}'
+    facets = safe_cache.get(key)
+    if facets is None:
+        facets = facet_counts(filter_homes(params))
+        safe_cache.set(key, facets, timeout)
+    return facets
@@ -0,0 +1,128 @@
+import hashlib
+from functools import reduce
+from operator import or_
+from urllib.parse import urlencode
+
+from django.contrib.gis.db.models.functions import Distance, GeometryDistance
+from django.contrib.gis.geos import Point
+from django.contrib.gis.measure import D
+from django.db.models import Q
+
+from properties.geo import FlipCoordinates, location_point, location_bbox, radius_bbox, parse_bbox
+from properties.models import Home, normalize_feature_key
+from properties.pagination import SORT_ORDERS, DEFAULT_SORT
+from properties.search import search_homes
+
+FILTER_PARAMS = ('type', 'city', 'state', 'min_price', 'max_price', 'min_area', 'max_area', 'bedrooms', 'bathrooms',
+                 'features', 'features_match', 'lat', 'lng', 'radius_km', 'bbox', 'q')
+
+
+def normalized_filter_key(params, names=FILTER_PARAMS):
+    """
+    A short stable key of the search parameters in `names`, the same whatever their order, letter case
+    (except for cursors) or empty values, e.g. for cache keys.
+    """
+    items = []
+    for name in sorted(names):
+        value = str(params.get(name) or '').strip()
+        if name != 'cursor':
+            value = value.lower()
+        if name == 'features':
+            value = ','.join(sorted({normalize_feature_key(key) for key in value.split(',') if key.strip()}))
+        if value:
+            items.append((name, value))
+    return hashlib.md5(urlencode(items).encode()).hexdigest()
+
+
+def filter_homes(params, queryset=None):
+    """
+    Apply the houses search parameters (type, city, state, price, area, bedrooms, bathrooms, features, the free
+    text `q` and the geo parameters) to the approved homes, or to the given queryset. `features` is a comma
+    separated list of keys, matched with any-of semantics unless `features_match=all` is given. Homes matching
+    `q` are annotated with their `rank`.
+
+    Geo search takes either `lat`, `lng` and `radius_km` or a `bbox=min_lng,min_lat,max_lng,max_lat`.
+    Given `lat` and `lng`, the homes are annotated with their index-assisted (KNN) `distance` for sorting.
+    """
+    if queryset is None:
+        queryset = Home.objects.filter(is_pending=False)
+    type_filter = params.get('type')  # AP or HO
+    city_filter = params.get('city')
+    state_filter = params.get('state')  # S or R
+    min_price = int(params.get('min_price', 0))
+    max_price = int(params.get('max_price', 1000000000))
+    min_area = int(params.get('min_area', 0))
+    max_area = int(params.get('max_area', 1000000))
+    bedrooms = int(params.get('bedrooms', '0'))
+    bathrooms = int(params.get('bathrooms', '0'))
+
+    if type_filter and type_filter != '':
+        queryset = queryset.filter(type__iexact=type_filter)
+    if city_filter and city_filter != '':
+        queryset = queryset.filter(location__city__icontains=city_filter)
+    if state_filter and state_filter != '':
+        queryset = queryset.filter(state__iexact=state_filter.upper()[0:1])
+    queryset = queryset.filter(price__range=(min_price, max_price))
+    queryset = queryset.filter(area__range=(min_area, max_area))
+    if bedrooms and bedrooms != 0:
+        if bedrooms >= 5:
+            queryset = queryset.filter(living_space__bedrooms__gte=bedrooms)
+        else:
+            queryset = queryset.filter(living_space__bedrooms__exact=bedrooms)
+
+    if bathrooms and bathrooms != 0:
+        if bathrooms >= 5:
+            queryset = queryset.filter(living_space__bathrooms__gte=bathrooms)
+        else:
+            queryset = queryset.filter(living_space__bathrooms__exact=bathrooms)
+    keys = params.get('features', None)
+    if keys:
+        keys = [normalize_feature_key(key) for key in keys.split(',') if key.strip()]
+        if len(keys) > 0:
+            # Features.data holds normalized [{"key": ...}] lists, so both semantics are jsonb containment
+            # checks answered by the GIN index on the joined features row.
+            if params.get('features_match') == 'all':
+                queryset = queryset.filter(features__data__contains=[{'key': key} for key in keys])
+            else:
+                queries = [Q(features__data__contains=[{'key': key}]) for key in keys]
+                queryset = queryset.filter(reduce(or_, queries))
+    q = params.get('q')
+    if q and q.strip():
+        queryset = search_homes(queryset, q)
+    return filter_homes_by_location(params, queryset)
+
+
+def filter_homes_by_location(params, queryset):
+    lat = params.get('lat')
+    lng = params.get('lng')
+    radius_km = params.get('radius_km')
+    bbox = params.get('bbox')
+
+    if bbox:
+        queryset = queryset.filter(location__coordinates__within=location_bbox(*parse_bbox(bbox)))
+    if lat and lng:
+        lat, lng = float(lat), float(lng)
+        point = location_point(lat, lng)
+        queryset = queryset.annotate(distance=GeometryDistance('location__coordinates', point))
+        if radius_km:
+            radius_km = float(radius_km)
+            # the box is answered by the spatial index, the exact spherical distance only checks what is left
+            queryset = queryset.filter(location__coordinates__within=radius_bbox(lat, lng, radius_km)) \
+                .annotate(radius_distance=Distance(FlipCoordinates('location__coordinates'),
+                                                   Point(lng, lat, srid=4326))) \
+                .filter(radius_distance__lte=D(km=radius_km))
+    elif lat or lng or radius_km:
+        raise ValueError('Geo search needs both lat and lng')
+    return queryset
+
+
+def search_sort(params):
+    has_query = bool((params.get('q') or '').strip())
+    sort = params.get('sort') or ('relevance' if has_query else DEFAULT_SORT)
+    if sort not in SORT_ORDERS:
+        raise ValueError(f'Unsupported sort: {sort}, should be one of {", ".join(SORT_ORDERS)}')
+    if sort == 'distance' and not (params.get('lat') and params.get('lng')):
+        raise ValueError('sort=distance needs lat and lng')
+    if sort == 'relevance' and not has_query:
+        raise ValueError('sort=relevance needs q')
+    return sort
@@ -0,0 +1,40 @@
+from math import cos, radians
+
+from django.contrib.gis.db.models.functions import GeomOutputGeoFunc
+from django.contrib.gis.geos import Point, Polygon
+
+KM_PER_DEGREE = 111.32  # length of one degree of latitude
+
+
+class FlipCoordinates(GeomOutputGeoFunc):
+    function = 'ST_FlipCoordinates'
+    arity = 1
+
+
+def location_point(lat, lng):
+    """
+    Location.coordinates keeps the latitude on the x axis (see LocationSerializer), so geometries compared
+    with the column directly, and therefore able to use its spatial index, are built in the same order.
+    """
+    return Point(lat, lng, srid=4326)
+
+
+def location_bbox(min_lng, min_lat, max_lng, max_lat):
+    bbox = Polygon.from_bbox((min_lat, min_lng, max_lat, max_lng))
+    bbox.srid = 4326
+    return bbox
+
+
+def radius_bbox(lat, lng, radius_km):
+    """ The box around a circle, used to narrow a radius search down with the spatial index """
+    lat_delta = radius_km / KM_PER_DEGREE
+    lng_delta = radius_km / (KM_PER_DEGREE * max(cos(radians(lat)), 0.01))
+    return location_bbox(lng - lng_delta, lat - lat_delta, lng + lng_delta, lat + lat_delta)
+
+
+def parse_bbox(value):
+    """ Parse a `min_lng,min_lat,max_lng,max_lat` box, the GeoJSON order """
+    values = [float(v) for v in value.split(',')]
+    if len(values) != 4:
+        raise ValueError(f'Invalid bbox: {value}, expected min_lng,min_lat,max_lng,max_lat')
+    return values
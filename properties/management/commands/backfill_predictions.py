@@ -0,0 +1,86 @@
+import json
+import os
+import time
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from properties.models import Home
+from properties.predictions import PREDICTION_TYPES, stale_predictions
+from properties.utils.price_prediction import current_model_version, predict_property_price_batch, price_models
+
+HOME_COLUMNS = ('id', 'area', 'type', 'living_space__bedrooms', 'living_space__bathrooms', 'location__city')
+
+
+def predict_rows(rows):
+    """
+    The model version and the [(home id, predicted price or None)] of HOME_COLUMNS rows, run by the pool
+    workers, which can swap to a new live version of the registry while the command runs
+    """
+    models = price_models()
+    records = [{'bedrooms': bedrooms, 'bathrooms': bathrooms, 'area': area,
+                'type': PREDICTION_TYPES.get(home_type, home_type), 'city': city}
+               for _, area, home_type, bedrooms, bathrooms, city in rows]
+    results = predict_property_price_batch(records, models)
+    return models.version, [(row[0], int(result['predicted_price']) if 'predicted_price' in result else None)
+                            for row, result in zip(rows, results)]
+
+
+class Command(BaseCommand):
+    help = 'Predict the price of the homes predicted by other models than the current ones, or of every home'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Predict every home, not only the stale ones')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--checkpoint', default='backfill_predictions.json',
+                            help='Where the last written home id is kept to resume an interrupted run')
+        parser.add_argument('--resume', action='store_true', help='Start after the home id of the checkpoint')
+
+    def handle(self, *args, **options):
+        homes = Home.objects.all() if options['all'] else stale_predictions()
+        version = current_model_version()
+        checkpoint = options['checkpoint']
+        if options['resume'] and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                state = json.load(f)
+            if state['model_version'] == version and state['all'] == options['all']:
+                homes = homes.filter(pk__gt=state['last_id'])
+                self.stdout.write(f'Resuming after home {state["last_id"]}')
+            else:
+                self.stdout.write('The checkpoint belongs to another run, starting over')
+
+        connections.close_all()  # the workers are forked, they should not share the connection
+        workers = max(options['workers'], 1)
+        started = time.perf_counter()
+        written = 0
+        with Pool(workers) as pool:
+            rows = homes.order_by('id').values_list(*HOME_COLUMNS).iterator(chunk_size=options['chunk_size'])
+            pending = deque()  # in id order, so the checkpoint never skips an unwritten chunk
+            while True:
+                chunk = list(islice(rows, options['chunk_size']))
+                if chunk:
+                    pending.append(pool.apply_async(predict_rows, (chunk,)))
+                if pending and (len(pending) >= 2 * workers or not chunk):
+                    written += self.write_chunk(*pending.popleft().get(), version, checkpoint, options['all'])
+                    elapsed = time.perf_counter() - started
+                    self.stdout.write(f'{written} homes, {written / elapsed:.0f} rows/sec')
+                elif not chunk:
+                    break
+
+        elapsed = time.perf_counter() - started
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        self.stdout.write(self.style.SUCCESS(
+            f'Predicted {written} homes in {elapsed:.1f} s, {written / elapsed if elapsed else 0:.0f} rows/sec'))
+
+    def write_chunk(self, model_version, predictions, run_version, checkpoint, all_homes):
+        homes = [Home(pk=home_id, predicted_price=price, prediction_model_version=model_version)
+                 for home_id, price in predictions]
+        Home.objects.bulk_update(homes, ['predicted_price', 'prediction_model_version'], batch_size=1000)
+        with open(checkpoint, 'w') as f:
+            json.dump({'model_version': run_version, 'all': all_homes, 'last_id': predictions[-1][0]}, f)
+        return len(homes)
@@ -0,0 +1,59 @@
+import os
+import time
+from itertools import product
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from properties.utils.compiled_model import COMPILED_MODEL_FILE, CompiledPriceModel, export_price_model
+from properties.utils.price_prediction import PriceModels, model_registry, models_dir, price_features
+
+
+def check_records(models):
+    """ Every type and city over a grid of sizes, to compare the compiled model with the fitted one """
+    return [{'bedrooms': bedrooms, 'bathrooms': bathrooms, 'area': area, 'type': home_type, 'city': city}
+            for home_type, city, bedrooms, bathrooms, area in product(
+                models.type_codes, models.city_columns, range(0, 7), range(0, 5), range(0, 6000, 150))]
+
+
+class Command(BaseCommand):
+    help = ('Compile the fitted price models into NumPy arrays, served without pandas or scikit-learn '
+            'when PRICE_MODELS_COMPILED is set')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--version', help='The registry version to compile, the current one by default')
+        parser.add_argument('--output', help=f'Where to write it, {COMPILED_MODEL_FILE} next to the models by default')
+
+    def handle(self, *args, **options):
+        registry = model_registry()
+        version = options['version'] or (registry.current() if registry else None)
+        try:
+            model_files_dir = models_dir(version)
+        except (OSError, ValueError) as e:
+            raise CommandError(e)
+        output = options['output'] or os.path.join(model_files_dir, COMPILED_MODEL_FILE)
+        staging = f'{output}.{os.getpid()}.tmp'  # workers may be loading the previous one
+
+        models = PriceModels(model_files_dir, version)
+        export_price_model(models, staging)
+        compiled = CompiledPriceModel(staging, models.version)
+
+        features = price_features(check_records(models), models)
+        started = time.perf_counter()
+        expected = models.predict(features)
+        fitted_time = time.perf_counter() - started
+        started = time.perf_counter()
+        predicted = compiled.predict(features)
+        compiled_time = time.perf_counter() - started
+        if not np.array_equal(expected, predicted):
+            os.remove(staging)
+            raise CommandError(f'The compiled model predicts differently on {np.sum(expected != predicted)} '
+                               f'of {len(features)} records, nothing written')
+        os.replace(staging, output)
+        if registry is not None and version is not None and not options['output']:
+            registry.record_compiled(version)  # lets the version be activated with PRICE_MODELS_COMPILED
+
+        self.stdout.write(f'{len(features)} records predicted identically, '
+                          f'fitted {fitted_time * 1000:.1f} ms, compiled {compiled_time * 1000:.1f} ms')
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote version {models.version} to {output} ({os.path.getsize(output) / 1024:.0f} KB)'))
@@ -0,0 +1,52 @@
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$')
+WORKER_IMPORTS = 'import django; django.setup(); import importlib; importlib.import_module(%r)'
+
+
+class Command(BaseCommand):
+    help = 'Report what importing the project costs a starting worker, per package and per module, slowest first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--module', default=settings.ROOT_URLCONF,
+                            help='The module a worker imports, the URLconf and so every view by default')
+        parser.add_argument('--limit', type=int, default=20, help='How many modules to list')
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE)
+        # a fresh interpreter, nothing is imported yet
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', WORKER_IMPORTS % options['module']],
+                                capture_output=True, text=True, env=env)
+        if result.returncode:
+            raise CommandError(result.stderr.strip().splitlines()[-1])
+
+        modules, packages = [], defaultdict(int)
+        for line in result.stderr.splitlines():
+            match = IMPORT_TIME_LINE.match(line)
+            if match:
+                own, cumulative, module = int(match[1]), int(match[2]), match[4]
+                modules.append((cumulative, own, module))
+                packages[module.split('.')[0]] += own
+        total = sum(packages.values())
+
+        self.stdout.write(f'Importing {options["module"]}: {total / 1000:.0f} ms, {len(modules)} modules')
+        self.stdout.write('\nPer package (own time of its modules):')
+        for package, own in sorted(packages.items(), key=lambda item: -item[1])[:options['limit']]:
+            self.stdout.write(f'{own / 1000:10.1f} ms  {own / total:6.1%}  {package}')
+        self.stdout.write('\nPer module (with what it imports):')
+        for cumulative, own, module in sorted(modules, reverse=True)[:options['limit']]:
+            self.stdout.write(f'{cumulative / 1000:10.1f} ms  {own / 1000:8.1f} ms own  {module}')
+
+        # loaded on first use, not on import
+        from properties.utils.price_prediction import PriceModels
+        started = time.perf_counter()
+        PriceModels()
+        self.stdout.write(f'\nLoading the price models: {(time.perf_counter() - started) * 1000:.0f} ms')
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from properties.utils.model_registry import CURRENT, MODEL_FILES, SHADOW
+from properties.utils.price_prediction import compiled_models_enabled, model_registry
+
+
+class Command(BaseCommand):
+    help = 'Manage the versions of the price models in the PRICE_MODEL_REGISTRY directory'
+
+    def add_arguments(self, parser):
+        actions = parser.add_subparsers(dest='action', required=True)
+        actions.add_parser('list', help='List the versions, marking the live and the shadow ones')
+        publish = actions.add_parser('publish', help='Copy a directory of model files in as a new version')
+        publish.add_argument('source', help='A directory with ' + ', '.join(MODEL_FILES))
+        publish.add_argument('version')
+        publish.add_argument('--description', default='')
+        activate = actions.add_parser('activate', help='Make a version live, the workers swap to it in the background, '
+                                      'then run backfill_predictions')
+        activate.add_argument('version')
+        shadow = actions.add_parser('shadow', help='Run a candidate version alongside the live one, or stop with --off')
+        shadow.add_argument('version', nargs='?')
+        shadow.add_argument('--off', action='store_true')
+
+    def handle(self, *args, **options):
+        registry = model_registry()
+        if registry is None:
+            raise CommandError('Set PRICE_MODEL_REGISTRY to the directory of the registry first')
+        try:
+            if options['action'] == 'publish':
+                manifest = registry.publish(options['source'], options['version'], options['description'])
+                self.stdout.write(self.style.SUCCESS(f'Published {manifest["version"]} ({manifest["sha256"]})'))
+            elif options['action'] == 'activate':
+                registry.set_pointer(CURRENT, options['version'], compiled_models_enabled())
+                self.stdout.write(self.style.SUCCESS(f'{options["version"]} is live'))
+                # saved homes are predicted with it as soon as the workers swap, the others are not
+                self.stdout.write('Run manage.py backfill_predictions to predict the other homes with it')
+            elif options['action'] == 'shadow':
+                if not options['off'] and not options['version']:
+                    raise CommandError('Give the version to shadow, or --off')
+                registry.set_pointer(SHADOW, None if options['off'] else options['version'], compiled_models_enabled())
+                self.stdout.write(self.style.SUCCESS('Shadowing stopped' if options['off']
+                                                     else f'Shadowing with {options["version"]}'))
+            else:
+                live, shadow = registry.current(), registry.shadow()
+                for version in registry.versions():
+                    manifest = registry.manifest(version)
+                    mark = 'live' if version == live else 'shadow' if version == shadow else ''
+                    self.stdout.write(f'{version:20} {mark:6} {manifest["published_at"]}  {manifest["description"]}')
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
@@ -0,0 +1,17 @@
+# Generated by Django 4.1.7 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('properties', '0002_alter_home_area'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='home',
+            index=models.Index(condition=models.Q(('is_pending', False)), fields=['-views', '-id'], name='home_approved_views_idx'),
+        ),
+    ]
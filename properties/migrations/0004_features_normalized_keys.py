@@ -0,0 +1,32 @@
+# Generated by Django 4.1.7 on 2026-10-18 10:31
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+def normalize_feature_keys(apps, schema_editor):
+    Features = apps.get_model('properties', 'Features')
+    for features in Features.objects.all().iterator():
+        keys = []
+        for e in features.data or []:
+            key = str(e['key']).strip().lower()
+            if key and key not in keys:
+                keys.append(key)
+        data = [{'key': key} for key in keys]
+        if data != features.data:
+            Features.objects.filter(pk=features.pk).update(data=data)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('properties', '0003_home_approved_views_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_feature_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='features',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['data'], name='features_data_gin_idx', opclasses=['jsonb_path_ops']),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.1.7 on 2026-10-18 11:47
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+
+def populate_search_vectors(apps, schema_editor):
+    # the expression of properties.search.home_search_vector() when this migration was written
+    Home = apps.get_model('properties', 'Home')
+    Location = apps.get_model('properties', 'Location')
+    location = Location.objects.filter(home_id=OuterRef('pk'))
+    Home.objects.update(
+        search_vector=SearchVector(Subquery(location.values('city')[:1]), weight='A', config='simple')
+        + SearchVector(Subquery(location.values('address')[:1]), weight='B', config='simple')
+        + SearchVector('description', weight='C', config='simple'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('properties', '0004_features_normalized_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='home',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(populate_search_vectors, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='home',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='home_search_vector_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.1.7 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('properties', '0005_home_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HomeChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('home_id', models.BigIntegerField()),
+                ('changed_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
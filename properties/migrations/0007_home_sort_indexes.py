@@ -0,0 +1,26 @@
+# Generated by Django 4.1.7 on 2026-10-18 15:22
+
+from django.db import migrations, models
+import django.db.models.functions.comparison
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('properties', '0006_homechange'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='home',
+            index=models.Index(condition=models.Q(('is_pending', False)), fields=['-add_date', '-id'], name='home_approved_newest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='home',
+            index=models.Index(condition=models.Q(('is_pending', False)), fields=['price', 'id'], name='home_approved_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='home',
+            index=models.Index(models.ExpressionWrapper(models.CombinedExpression(django.db.models.functions.comparison.Cast('price', models.FloatField()), '/', models.F('area')), output_field=models.FloatField()), models.F('id'), condition=models.Q(('area__gt', 0), ('is_pending', False)), name='home_approved_ppa_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.7 on 2026-10-18 15:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('properties', '0007_home_sort_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='home',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='home',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.1.7 on 2026-10-18 16:31
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def copy_visited_by(apps, schema_editor):
+    # the M2M kept no time, the existing visits are logged as of now
+    Home = apps.get_model('properties', 'Home')
+    HomeVisit = apps.get_model('properties', 'HomeVisit')
+    now = django.utils.timezone.now()
+    visits = Home.visited_by.through.objects.values_list('user_id', 'home_id').iterator(chunk_size=2000)
+    batch = []
+    for user_id, home_id in visits:
+        batch.append(HomeVisit(user_id=user_id, home_id=home_id, visited_at=now))
+        if len(batch) == 2000:
+            HomeVisit.objects.bulk_create(batch)
+            batch = []
+    HomeVisit.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('properties', '0008_home_version_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HomeVisit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('visited_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('home', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='visits', to='properties.home')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='home_visits', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='homevisit',
+            index=models.Index(fields=['user', '-visited_at'], name='homevisit_user_recent_idx'),
+        ),
+        migrations.RunPython(copy_visited_by, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='home',
+            name='visited_by',
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.7 on 2026-10-18 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('properties', '0009_homevisit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='home',
+            name='predicted_price',
+            field=models.PositiveIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='home',
+            name='prediction_model_version',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+    ]
@@ -2,7 +2,11 @@ from datetime import datetime, date
 from django.contrib.auth import get_user_model
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.db.models.functions import Cast
+from django.utils import timezone
 from django.contrib.gis.db import models as geo_models
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.utils.safestring import mark_safe
 from storages.backends.s3boto3 import S3Boto3Storage
 
@@ -16,11 +20,19 @@ STATE_TYPES_OPTIONS = (
     ('S', 'SELL'),
 )
 
+# Sort key of the price_per_area search order, the same expression as its index
+PRICE_PER_AREA = models.ExpressionWrapper(Cast('price', models.FloatField()) / models.F('area'),
+                                          output_field=models.FloatField())
+
 
 def current_year():
     return date.today().year
 
 
+def normalize_feature_key(key):
+    return str(key).strip().lower()
+
+
 def upload_to_properties(instance, filename):
     return f"properties/{instance.home.owner.id}/{instance.home.id}/images/{filename}"
 
@@ -29,14 +41,23 @@ def upload_to_ownership_record(instance, filename):
     return f"properties/{instance.home.owner.id}/{instance.home.id}/ownership_record/{filename}"
 
 
+class HomeQuerySet(models.QuerySet):
+    def for_cards(self):
+        """
+        Load everything a home card shows in a constant number of queries: the one-to-one rows are joined
+        and the first image of every home in the page is fetched by a single DISTINCT ON query.
+        """
+        first_images = Image.objects.order_by('home_id', 'id').distinct('home_id')
+        return self.select_related('living_space', 'features', 'location') \
+            .prefetch_related(models.Prefetch('images', queryset=first_images, to_attr='first_images'))
+
+
 class Home(models.Model):
     price = models.PositiveIntegerField(verbose_name='Price')
     area = models.PositiveIntegerField(help_text='The Area of the house in square foot', default=0)
     owner = models.ForeignKey(to=get_user_model(), on_delete=models.CASCADE, related_name="properties")
     favourite_by = models.ManyToManyField(to=get_user_model(), related_name='favourites',
                                           related_query_name='favourite_by')
-    visited_by = models.ManyToManyField(to=get_user_model(), related_name='visited',
-                                        related_query_name='visited_by')
     description = models.TextField(blank=True)
     add_date = models.DateTimeField(editable=False)
     built_year = models.PositiveSmallIntegerField(help_text='The year when the home built, limits[1900,current year]',
@@ -46,6 +67,29 @@ class Home(models.Model):
     type = models.CharField(choices=HOME_TYPES_OPTIONS, max_length=3)
     state = models.CharField(choices=STATE_TYPES_OPTIONS, max_length=2)
     is_pending = models.BooleanField(default=True)
+    search_vector = SearchVectorField(null=True, editable=False)  # maintained by properties.signals
+    # bumped by properties.signals whenever the home or one of its rows changes, for conditional requests
+    version = models.PositiveIntegerField(default=1, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+    # stored by properties.predictions when the home, its living space or its location change
+    predicted_price = models.PositiveIntegerField(null=True, editable=False)
+    prediction_model_version = models.CharField(max_length=64, blank=True, editable=False)
+
+    objects = HomeQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # keyset pagination of the approved homes in every sort order, see properties.pagination
+            models.Index(fields=['-views', '-id'], condition=models.Q(is_pending=False),
+                         name='home_approved_views_idx'),
+            models.Index(fields=['-add_date', '-id'], condition=models.Q(is_pending=False),
+                         name='home_approved_newest_idx'),
+            models.Index(fields=['price', 'id'], condition=models.Q(is_pending=False),  # also scanned backwards
+                         name='home_approved_price_idx'),
+            models.Index(PRICE_PER_AREA, models.F('id'), condition=models.Q(is_pending=False, area__gt=0),
+                         name='home_approved_ppa_idx'),
+            GinIndex(fields=['search_vector'], name='home_search_vector_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         """ On save, update timestamps """
@@ -100,6 +144,22 @@ class Features(models.Model):
     data = models.JSONField()
     home = models.OneToOneField('Home', on_delete=models.CASCADE, related_name='features')
 
+    class Meta:
+        indexes = [
+            # serves the jsonb containment (@>) lookups of the features search filter
+            GinIndex(fields=['data'], opclasses=['jsonb_path_ops'], name='features_data_gin_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        """ On save, store the keys normalized and without duplicates, e.g. [{"key": "pool"}] """
+        keys = []
+        for e in self.data or []:
+            key = normalize_feature_key(e['key'])
+            if key and key not in keys:
+                keys.append(key)
+        self.data = [{'key': key} for key in keys]
+        return super(Features, self).save(*args, **kwargs)
+
     def __str__(self):
         return str(self.id)
 
@@ -121,3 +181,21 @@ class Image(models.Model):
 
     def __str__(self):
         return 'Image {}'.format(self.id)
+
+
+class HomeChange(models.Model):
+    """ Append-only feed of changed homes, read by properties.search_index to stay up to date """
+    home_id = models.BigIntegerField()
+    changed_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+class HomeVisit(models.Model):
+    """ Append-only log of the homes the users saw, written behind by properties.view_counter """
+    user = models.ForeignKey(to=get_user_model(), on_delete=models.CASCADE, related_name='home_visits')
+    home = models.ForeignKey('Home', on_delete=models.CASCADE, related_name='visits')
+    visited_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-visited_at'], name='homevisit_user_recent_idx'),
+        ]
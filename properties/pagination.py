@@ -0,0 +1,112 @@
+import base64
+import datetime
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+from properties.models import PRICE_PER_AREA
+
+# Every ordering ends with the primary key so that the position of a home in it is unique.
+# Each one matches a partial index on the approved homes, see Home.Meta.indexes.
+SORT_ORDERS = {
+    'views': ('-views', '-id'),
+    'newest': ('-add_date', '-id'),
+    'price_asc': ('price', 'id'),
+    'price_desc': ('-price', '-id'),
+    'price_per_area': ('price_per_area', 'id'),  # homes without an area are left out
+    'distance': ('distance', 'id'),  # annotated by properties.filters when lat and lng are given
+    'relevance': ('-rank', '-id'),  # annotated by properties.filters when q is given
+}
+DEFAULT_SORT = 'views'
+INTEGER_FIELDS = {'views', 'price', 'id'}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()  # DjangoJSONEncoder drops the microseconds, a cursor needs the exact value
+        return super().default(o)
+
+
+def encode_cursor(sort, values):
+    payload = json.dumps([sort, values], cls=CursorEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def cursor_value_is_valid(field, value):
+    name = field.lstrip('-')
+    if isinstance(value, bool):
+        return False
+    if name in INTEGER_FIELDS:
+        return isinstance(value, int)
+    if name == 'add_date':
+        try:
+            datetime.datetime.fromisoformat(value)
+        except (ValueError, TypeError):
+            return False
+        return True
+    return isinstance(value, (int, float))
+
+
+def decode_cursor(cursor):
+    """ The sort order and the values of `cursor`, checked to fit the fields of that order """
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        sort, values = json.loads(payload)
+    except (ValueError, TypeError):
+        raise InvalidCursor(f'Invalid cursor: {cursor}')
+    if sort not in SORT_ORDERS or not isinstance(values, list) or len(values) != len(SORT_ORDERS[sort]):
+        raise InvalidCursor(f'Invalid cursor: {cursor}')
+    if not all(cursor_value_is_valid(field, value) for field, value in zip(SORT_ORDERS[sort], values)):
+        raise InvalidCursor(f'Invalid cursor: {cursor}')
+    return sort, values
+
+
+def keyset_condition(ordering, values):
+    """
+    Build the condition selecting the rows that come after `values` in `ordering`, e.g. for ('-views', '-id'):
+    views < v OR (views = v AND id < i). Unlike OFFSET, this lets the database start reading right at the cursor.
+    """
+    condition = None
+    for field, value in reversed(list(zip(ordering, values))):
+        name = field.lstrip('-')
+        after = Q(**{f'{name}__{"lt" if field.startswith("-") else "gt"}': value})
+        condition = after if condition is None else after | (Q(**{name: value}) & condition)
+    return condition
+
+
+def keyset_queryset(queryset, sort, cursor):
+    """ Order `queryset` in the given sort order and skip the homes up to `cursor` """
+    ordering = SORT_ORDERS[sort]
+    if sort == 'price_per_area':
+        queryset = queryset.filter(area__gt=0).annotate(price_per_area=PRICE_PER_AREA)
+    queryset = queryset.order_by(*ordering)
+    if cursor:
+        cursor_sort, values = decode_cursor(cursor)
+        if cursor_sort != sort:
+            raise InvalidCursor(f'The cursor belongs to the "{cursor_sort}" order, not "{sort}"')
+        queryset = queryset.filter(keyset_condition(ordering, values))
+    return queryset
+
+
+def cursor_after(home, sort):
+    return encode_cursor(sort, [getattr(home, field.lstrip('-')) for field in SORT_ORDERS[sort]])
+
+
+def paginate_homes(queryset, sort, cursor, limit):
+    """
+    Return one page of `queryset` in the given sort order, starting after `cursor`,
+    together with the cursor of the next page (None on the last page).
+    """
+    homes = list(keyset_queryset(queryset, sort, cursor)[:limit + 1])  # one extra row tells if there is a next page
+    next_cursor = None
+    if len(homes) > limit:
+        homes = homes[:limit]
+        if homes:
+            next_cursor = cursor_after(homes[-1], sort)
+    return homes, next_cursor
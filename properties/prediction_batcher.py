@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from django.conf import settings
+
+from properties.utils.price_prediction import predict_property_price_batch
+
+logger = logging.getLogger(__name__)
+
+
+class PredictionBatcher:
+    """
+    Coalesce the price predictions asked within PRICE_PREDICTION_BATCH_WINDOW seconds of each other, up to
+    PRICE_PREDICTION_BATCH_SIZE records, into one vectorized prediction on a worker thread. Threads wait with
+    predict(), coroutines with apredict(); each gets the result of its own record.
+    """
+
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.worker = None
+        self.batches = deque(maxlen=1000)  # (size, seconds waited by the first record, seconds predicting)
+        self.total_batches = 0
+        self.total_predictions = 0
+
+    def submit(self, record):
+        future = Future()
+        self.queue.put((record, future, time.perf_counter()))
+        if self.worker is None or not self.worker.is_alive():
+            with self.lock:
+                if self.worker is None or not self.worker.is_alive():
+                    self.worker = threading.Thread(target=self.run, daemon=True)
+                    self.worker.start()
+        return future
+
+    def predict(self, record):
+        """ {'predicted_price': price} or {'errors': {field: message}}, like predict_property_price_batch """
+        return self.submit(record).result()
+
+    async def apredict(self, record):
+        return await asyncio.wrap_future(self.submit(record))
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            # skip the records whose caller gave up, e.g. a cancelled apredict(); the others can't be cancelled now
+            batch = [item for item in self.next_batch() if item[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            started = time.perf_counter()
+            try:
+                results = predict_property_price_batch([record for record, _, _ in batch])
+            except Exception as e:
+                logger.exception('Predicting a batch of %d prices failed', len(batch))
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            finished = time.perf_counter()
+            with self.lock:
+                self.batches.append((len(batch), started - batch[0][2], finished - started))
+                self.total_batches += 1
+                self.total_predictions += len(batch)
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+    def stats(self):
+        """ Totals, and the sizes and latencies of the last 1000 batches """
+        with self.lock:
+            batches = list(self.batches)
+            stats = {'batches': self.total_batches, 'predictions': self.total_predictions,
+                     'window_ms': self.window * 1000, 'max_batch_size': self.max_size}
+        if batches:
+            sizes = sorted(size for size, _, _ in batches)
+            waits = sorted(wait for _, wait, _ in batches)
+            latencies = sorted(latency for _, _, latency in batches)
+            stats['recent'] = {
+                'batches': len(batches),
+                'mean_size': sum(sizes) / len(sizes),
+                'max_size': sizes[-1],
+                'p50_wait_ms': waits[len(waits) // 2] * 1000,
+                'p50_predict_ms': latencies[len(latencies) // 2] * 1000,
+                'p95_predict_ms': latencies[int(len(latencies) * 0.95)] * 1000,
+            }
+        return stats
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def prediction_batcher():
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = PredictionBatcher(getattr(settings, 'PRICE_PREDICTION_BATCH_WINDOW', 0.002),
+                                             getattr(settings, 'PRICE_PREDICTION_BATCH_SIZE', 64))
+    return _batcher
@@ -0,0 +1,58 @@
+import logging
+
+from properties.models import Home, HOME_TYPES_OPTIONS, LivingSpace, Location
+from properties.utils.price_prediction import current_model_version, predict_property_price_batch, price_models
+
+logger = logging.getLogger(__name__)
+
+PREDICTION_TYPES = dict(HOME_TYPES_OPTIONS)  # AP -> APARTMENT, the labels the encoder was fitted on
+
+
+def price_record(home):
+    """ The predictor input of the home, or None while it has no living space or location """
+    try:
+        living_space, location = home.living_space, home.location
+    except (LivingSpace.DoesNotExist, Location.DoesNotExist):
+        return None
+    return {
+        'bedrooms': living_space.bedrooms,
+        'bathrooms': living_space.bathrooms,
+        'area': home.area,
+        'type': PREDICTION_TYPES.get(home.type, home.type),
+        'city': location.city,
+        'price': home.price,  # not a feature, lets a shadow model be compared with the listing prices
+    }
+
+
+def predict_home_prices(homes, models=None):
+    """ The predicted prices of the homes, in one batch, with None for those the models cannot price """
+    records = [price_record(home) for home in homes]
+    results = iter(predict_property_price_batch([record for record in records if record is not None], models))
+    prices = []
+    for record in records:
+        result = next(results) if record is not None else {}
+        prices.append(int(result['predicted_price']) if 'predicted_price' in result else None)
+    return prices
+
+
+def update_predicted_prices(home_ids):
+    """
+    Predict and store the prices of the homes. When the models cannot be loaded or fail, the homes are saved
+    anyway, without a prediction nor a model version, for manage.py backfill_predictions to predict later.
+    """
+    homes = list(Home.objects.filter(pk__in=home_ids).select_related('living_space', 'location'))
+    try:
+        models = price_models()
+        prices, version = predict_home_prices(homes, models), models.version
+    except Exception:
+        logger.exception('Predicting the price of the homes %s failed', home_ids)
+        prices, version = [None] * len(homes), ''
+    for home, price in zip(homes, prices):
+        home.predicted_price = price
+        home.prediction_model_version = version
+    Home.objects.bulk_update(homes, ['predicted_price', 'prediction_model_version'])
+
+
+def stale_predictions():
+    """ The homes predicted by other models than the current ones, or never predicted """
+    return Home.objects.exclude(prediction_model_version=current_model_version())
@@ -0,0 +1,21 @@
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db.models import F, FloatField, OuterRef, Subquery
+from django.db.models.functions import Cast
+
+SEARCH_CONFIG = 'simple'  # listings mix Arabic and English, so words are indexed without stemming
+
+
+def home_search_vector(location_model):
+    """ The Home.search_vector expression over the description and the location address and city """
+    location = location_model.objects.filter(home_id=OuterRef('pk'))
+    return SearchVector(Subquery(location.values('city')[:1]), weight='A', config=SEARCH_CONFIG) \
+        + SearchVector(Subquery(location.values('address')[:1]), weight='B', config=SEARCH_CONFIG) \
+        + SearchVector('description', weight='C', config=SEARCH_CONFIG)
+
+
+def search_homes(queryset, q):
+    """ Keep the homes matching the web search style query `q`, annotated with their `rank` """
+    query = SearchQuery(q, search_type='websearch', config=SEARCH_CONFIG)
+    # ts_rank is a real, cast so that the value used in pagination cursors compares equal to the column
+    return queryset.filter(search_vector=query) \
+        .annotate(rank=Cast(SearchRank(F('search_vector'), query), FloatField()))
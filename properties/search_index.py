@@ -0,0 +1,266 @@
+import logging
+import threading
+import time
+import zlib
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from properties.models import Home, HomeChange, HOME_TYPES_OPTIONS, STATE_TYPES_OPTIONS, normalize_feature_key
+from properties.pagination import DEFAULT_SORT, InvalidCursor, decode_cursor, encode_cursor
+
+logger = logging.getLogger(__name__)
+
+TYPE_CODES = {home_type: code for code, (home_type, _) in enumerate(HOME_TYPES_OPTIONS)}
+STATE_CODES = {state: code for code, (state, _) in enumerate(STATE_TYPES_OPTIONS)}
+COLUMNS = ('id', 'price', 'area', 'views', 'type', 'state', 'location__city', 'living_space__bedrooms',
+           'living_space__bathrooms', 'features__data')
+UNSUPPORTED_PARAMS = ('q', 'lat', 'lng', 'radius_km', 'bbox')  # answered by the database only
+FEED_RETENTION = timedelta(days=1)
+FEED_PRUNE_INTERVAL = 60 * 60
+BUILD_GAP_WINDOW = 1000  # change ids below the last one checked for gaps when building
+
+
+def search_index_enabled():
+    return getattr(settings, 'HOMES_SEARCH_INDEX', False)
+
+
+def record_home_changes(home_ids):
+    if search_index_enabled():
+        HomeChange.objects.bulk_create([HomeChange(home_id=home_id) for home_id in home_ids])
+
+
+class HomeSearchIndex:
+    """
+    The approved homes as NumPy columns, with their feature keys as a bitmask, answering the houses search
+    filters with vectorized masks. It is built once, then kept up to date from the HomeChange feed.
+
+    Change ids are taken at insert time but transactions commit in any order, so an id missing below the last
+    one read may still show up: it is kept as a gap and read again by every refresh, for
+    HOMES_SEARCH_INDEX_GAP_TIMEOUT seconds, after which it is taken for a rolled back change.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.cities = []  # city code -> lowercased city
+        self.city_codes = {}
+        self.feature_bits = {}  # feature key -> bit
+        self.last_change_id = 0
+        self.gaps = {}  # missing change id -> time.monotonic() it was found missing
+        self.clear()
+
+    def clear(self):
+        self.ids = np.empty(0, dtype=np.int64)
+        self.price = np.empty(0, dtype=np.int64)
+        self.area = np.empty(0, dtype=np.int64)
+        self.views = np.empty(0, dtype=np.int64)
+        self.type = np.empty(0, dtype=np.int8)
+        self.state = np.empty(0, dtype=np.int8)
+        self.city = np.empty(0, dtype=np.int32)
+        self.bedrooms = np.empty(0, dtype=np.int16)
+        self.bathrooms = np.empty(0, dtype=np.int16)
+        self.features = np.zeros((0, 1), dtype=np.uint64)
+        self.alive = np.empty(0, dtype=bool)
+        self.rows = {}  # home id -> row of its live entry
+
+    def build(self):
+        last_change_id = HomeChange.objects.aggregate(last=Max('id'))['last'] or 0
+        first_id = max(last_change_id - BUILD_GAP_WINDOW, 0)
+        recent = set(HomeChange.objects.filter(id__gt=first_id).values_list('id', flat=True))
+        rows = list(Home.objects.filter(is_pending=False).values_list(*COLUMNS))
+        now = time.monotonic()
+        with self.lock:
+            self.clear()
+            self.append(rows)
+            self.last_change_id = last_change_id
+            self.gaps = {change_id: now for change_id in range(first_id + 1, last_change_id) if change_id not in recent}
+
+    def refresh(self):
+        """ Apply the changes recorded in the feed since the last refresh, and those of the gaps committed since """
+        changes = list(HomeChange.objects.filter(Q(id__gt=self.last_change_id) | Q(id__in=list(self.gaps)))
+                       .order_by('id').values_list('id', 'home_id'))
+        home_ids = {home_id for _, home_id in changes}
+        rows = list(Home.objects.filter(pk__in=home_ids, is_pending=False).values_list(*COLUMNS))
+        now = time.monotonic()
+        timeout = getattr(settings, 'HOMES_SEARCH_INDEX_GAP_TIMEOUT', 5 * 60)
+        with self.lock:
+            for home_id in home_ids:
+                row = self.rows.pop(home_id, None)
+                if row is not None:
+                    self.alive[row] = False
+            self.append(rows)
+            seen = {change_id for change_id, _ in changes}
+            last_change_id = max(seen | {self.last_change_id})
+            gaps = {change_id: found for change_id, found in self.gaps.items()
+                    if change_id not in seen and now - found < timeout}
+            gaps.update((change_id, now) for change_id in range(self.last_change_id + 1, last_change_id)
+                        if change_id not in seen)
+            self.gaps, self.last_change_id = gaps, last_change_id
+            if len(self.alive) > 2 * len(self.rows):
+                self.compact()
+
+    def change_token(self):
+        """ Tells apart the sets of applied changes: those up to last_change_id but the gaps """
+        with self.lock:
+            if not self.gaps:
+                return str(self.last_change_id)
+            return f'{self.last_change_id}.{zlib.crc32(",".join(map(str, sorted(self.gaps))).encode()):x}'
+
+    def compact(self):
+        keep = self.alive
+        for name in ('ids', 'price', 'area', 'views', 'type', 'state', 'city', 'bedrooms', 'bathrooms', 'features',
+                     'alive'):
+            setattr(self, name, getattr(self, name)[keep])
+        self.rows = {int(home_id): row for row, home_id in enumerate(self.ids)}
+
+    def city_code(self, city):
+        city = (city or '').lower()
+        if city not in self.city_codes:
+            self.city_codes[city] = len(self.cities)
+            self.cities.append(city)
+        return self.city_codes[city]
+
+    def feature_mask(self, keys):
+        """ The bitmask of the given feature keys, unknown keys are left out """
+        mask = np.zeros(self.features.shape[1], dtype=np.uint64)
+        for key in keys:
+            bit = self.feature_bits.get(key)
+            if bit is not None:
+                mask[bit // 64] |= np.uint64(1 << (bit % 64))
+        return mask
+
+    def append(self, rows):
+        if not rows:
+            return
+        ids, price, area, views, types, states, cities, bedrooms, bathrooms, features = zip(*rows)
+        for data in features:
+            for e in data or []:
+                self.feature_bits.setdefault(normalize_feature_key(e['key']), len(self.feature_bits))
+        words = max(1, (len(self.feature_bits) + 63) // 64)
+        if words > self.features.shape[1]:
+            self.features = np.hstack([self.features,
+                                       np.zeros((len(self.features), words - self.features.shape[1]), np.uint64)])
+        new_features = np.zeros((len(rows), words), dtype=np.uint64)
+        for row, data in enumerate(features):
+            new_features[row] = self.feature_mask(normalize_feature_key(e['key']) for e in data or [])
+
+        start = len(self.ids)
+        self.ids = np.concatenate([self.ids, np.array(ids, dtype=np.int64)])
+        self.price = np.concatenate([self.price, np.array(price, dtype=np.int64)])
+        self.area = np.concatenate([self.area, np.array(area, dtype=np.int64)])
+        self.views = np.concatenate([self.views, np.array(views, dtype=np.int64)])
+        self.type = np.concatenate([self.type, np.array([TYPE_CODES.get(t, -1) for t in types], dtype=np.int8)])
+        self.state = np.concatenate([self.state, np.array([STATE_CODES.get(s, -1) for s in states], dtype=np.int8)])
+        self.city = np.concatenate([self.city, np.array([self.city_code(c) for c in cities], dtype=np.int32)])
+        # homes without a living space never match a bedrooms or bathrooms filter, like the database join
+        self.bedrooms = np.concatenate([self.bedrooms, np.array([-1 if b is None else b for b in bedrooms],
+                                                                dtype=np.int16)])
+        self.bathrooms = np.concatenate([self.bathrooms, np.array([-1 if b is None else b for b in bathrooms],
+                                                                  dtype=np.int16)])
+        self.features = np.vstack([self.features, new_features])
+        self.alive = np.concatenate([self.alive, np.ones(len(rows), dtype=bool)])
+        for offset, home_id in enumerate(ids):
+            self.rows[home_id] = start + offset
+
+    def filter_mask(self, params):
+        """ The rows matching the filters of properties.filters.filter_homes """
+        mask = self.alive.copy()
+        type_filter = (params.get('type') or '').upper()
+        if type_filter:
+            mask &= self.type == TYPE_CODES.get(type_filter, -2)
+        city_filter = (params.get('city') or '').lower()
+        if city_filter:
+            codes = [code for code, city in enumerate(self.cities) if city_filter in city]
+            mask &= np.isin(self.city, codes)
+        state_filter = (params.get('state') or '').upper()[0:1]
+        if state_filter:
+            mask &= self.state == STATE_CODES.get(state_filter, -2)
+        min_price, max_price = int(params.get('min_price', 0)), int(params.get('max_price', 1000000000))
+        min_area, max_area = int(params.get('min_area', 0)), int(params.get('max_area', 1000000))
+        mask &= (self.price >= min_price) & (self.price <= max_price)
+        mask &= (self.area >= min_area) & (self.area <= max_area)
+        for name, column in (('bedrooms', self.bedrooms), ('bathrooms', self.bathrooms)):
+            rooms = int(params.get(name, '0'))
+            if rooms:
+                mask &= (column >= rooms) if rooms >= 5 else (column == rooms)
+        keys = [normalize_feature_key(key) for key in (params.get('features') or '').split(',') if key.strip()]
+        if keys:
+            wanted = self.feature_mask(keys)
+            if params.get('features_match') == 'all':
+                if any(key not in self.feature_bits for key in keys):
+                    return np.zeros_like(mask)
+                mask &= ((self.features & wanted) == wanted).all(axis=1)
+            else:
+                mask &= (self.features & wanted).any(axis=1)
+        return mask
+
+    def search(self, params, limit):
+        """
+        The (home ids, next cursor) page of the houses search, like properties.views.homes_cards_page,
+        or None when the search needs the database.
+        """
+        if any(params.get(name) for name in UNSUPPORTED_PARAMS) or (params.get('sort') or DEFAULT_SORT) != 'views':
+            return None
+        with self.lock:
+            mask = self.filter_mask(params)
+            cursor = params.get('cursor')
+            if cursor:
+                sort, (views, home_id) = decode_cursor(cursor)
+                if sort != 'views':
+                    raise InvalidCursor(f'The cursor belongs to the "{sort}" order, not "views"')
+                mask &= (self.views < views) | ((self.views == views) & (self.ids < home_id))
+
+            candidates = np.flatnonzero(mask)
+            wanted = limit + 1  # one extra row tells whether there is a next page
+            if len(candidates) > wanted:
+                # keep the top views, with every tie of the last one so that ids order them exactly below
+                views = self.views[candidates]
+                top = np.argpartition(-views, wanted - 1)[:wanted]
+                candidates = candidates[views >= views[top].min()]
+            candidates = candidates[np.lexsort((-self.ids[candidates], -self.views[candidates]))][:wanted]
+
+            next_cursor = None
+            if len(candidates) > limit:
+                candidates = candidates[:limit]
+                if len(candidates):
+                    last = candidates[-1]
+                    next_cursor = encode_cursor('views', [int(self.views[last]), int(self.ids[last])])
+            return [int(home_id) for home_id in self.ids[candidates]], next_cursor
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def keep_refreshed(index):
+    interval = getattr(settings, 'HOMES_SEARCH_INDEX_REFRESH_INTERVAL', 1)
+    pruned_at = time.monotonic()
+    while True:
+        time.sleep(interval)
+        try:
+            close_old_connections()
+            index.refresh()
+            if time.monotonic() - pruned_at > FEED_PRUNE_INTERVAL:
+                HomeChange.objects.filter(changed_at__lt=timezone.now() - FEED_RETENTION).delete()
+                pruned_at = time.monotonic()
+        except Exception:
+            logger.exception('Refreshing the homes search index failed')
+
+
+def search_index():
+    """ The process wide HomeSearchIndex, built on first use, or None unless HOMES_SEARCH_INDEX is enabled """
+    global _index
+    if not search_index_enabled():
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                index = HomeSearchIndex()
+                index.build()
+                threading.Thread(target=keep_refreshed, args=(index,), daemon=True).start()
+                _index = index
+    return _index
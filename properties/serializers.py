@@ -6,7 +6,6 @@ from django.db import transaction
 from rest_framework import serializers
 
 from properties.models import Home, Location, LivingSpace, Features, Apartment, House, Image, Ownership
-from properties.utils.price_prediction import predict_property_price
 
 
 class LivingSpaceSerializer(serializers.ModelSerializer):
@@ -286,7 +285,10 @@ class HomeCardsSerializer(serializers.ModelSerializer):
                   'features', 'location']
 
     def get_first_image(self, obj):
-        first_image = obj.images.first()
+        if hasattr(obj, 'first_images'):  # prefetched by Home.objects.for_cards()
+            first_image = obj.first_images[0] if obj.first_images else None
+        else:
+            first_image = obj.images.first()
         if first_image:
             return ImageSerializer(first_image).data
         return None
@@ -338,28 +340,20 @@ class HomeRepresentationSerializer(serializers.ModelSerializer):
     apartment = ApartmentSerializer(read_only=True)
     house = HouseSerializer(read_only=True)
     location = LocationSerializer()
+    visited_by = serializers.SerializerMethodField()  # was a many to many field before HomeVisit
 
     class Meta:
         model = Home
-        fields = '__all__'
+        # bookkeeping of the search, the conditional requests and the predictions, served as `prediction`
+        exclude = ('search_vector', 'version', 'updated_at', 'predicted_price', 'prediction_model_version')
+
+    def get_visited_by(self, instance):
+        return list(instance.visits.order_by('user_id').values_list('user_id', flat=True).distinct())
 
     def to_representation(self, instance):
         data = super().to_representation(instance)
-        p_type = ''
-        if data['type'] == 'HO':
-            p_type = 'HOUSE'
-        else:
-            p_type = 'Apartment'.upper()
-        record = {
-            "bedrooms": data['living_space']['bedrooms'],
-            "bathrooms": data['living_space']['bathrooms'],
-            "area": data['area'],
-            "type": p_type,
-            "city": data['location']['city']
-        }
-        print(record)
-        prediction = predict_property_price(record)
-        data['prediction'] = int(prediction['predicted_price'])
+        # stored by properties.signals, and by manage.py backfill_predictions after a model upgrade
+        data['prediction'] = instance.predicted_price
         if data['owner'] and data['owner'] != '':
             data['owner_name'] = get_user_model().objects.get(id=data['owner']).username
         return data
@@ -0,0 +1,131 @@
+import threading
+
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete, pre_save, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from properties.card_cache import invalidate_cards, invalidate_card_fragments
+from properties.models import Home, Location, LivingSpace, Features, Image
+from properties.predictions import update_predicted_prices
+from properties.search import home_search_vector
+from properties.search_index import record_home_changes
+from properties.tiles import invalidate_tiles
+
+
+pending_predictions = threading.local()
+
+
+def update_search_vectors(home_ids):
+    Home.objects.filter(pk__in=home_ids).update(search_vector=home_search_vector(Location))
+
+
+def touch_homes(home_ids):
+    """ Bump the version and updated_at of the given homes, which their conditional responses depend on """
+    Home.objects.filter(pk__in=home_ids).update(version=F('version') + 1, updated_at=timezone.now())
+
+
+def homes_updated(home_ids, coordinates=(), cities=(), types=()):
+    """
+    Invalidate what is cached about the given homes, e.g. after QuerySet.update(). `coordinates`, `cities` and
+    `types` add the places and types the homes had before the change. The caches are only invalidated once
+    the change is committed, so that a read in between cannot cache the old rows again.
+    """
+    home_ids = list(home_ids)
+    touch_homes(home_ids)
+    record_home_changes(home_ids)
+    locations = list(Location.objects.filter(home_id__in=home_ids).values_list('coordinates', 'city'))
+    points = [point for point, _ in locations] + list(coordinates)
+    cities = [city for _, city in locations] + list(cities)
+    types = set(types) | set(Home.objects.filter(pk__in=home_ids).values_list('type', flat=True))
+    transaction.on_commit(lambda: invalidate_homes(home_ids, points, cities, types))
+
+
+def invalidate_homes(home_ids, points, cities, types):
+    invalidate_card_fragments(home_ids)
+    invalidate_tiles(points)
+    invalidate_cards(cities, types)
+
+
+@receiver(pre_save, sender=Home)
+def remember_previous_type(sender, instance, **kwargs):
+    instance.previous_type = None
+    if instance.pk is not None:
+        instance.previous_type = sender.objects.filter(pk=instance.pk).values_list('type', flat=True).first()
+
+
+@receiver(post_save, sender=Home)
+def handle_home_saved(sender, instance, **kwargs):
+    update_search_vectors([instance.pk])
+    previous_type = getattr(instance, 'previous_type', None)
+    homes_updated([instance.pk], types=[previous_type] if previous_type else [])
+
+
+@receiver(post_save, sender=Home)
+@receiver(post_save, sender=LivingSpace)
+@receiver(post_save, sender=Location)
+def handle_prediction_inputs_changed(sender, instance, **kwargs):
+    # once per transaction, for every home it saved, rather than at each save of a home and its rows
+    home_ids = getattr(pending_predictions, 'home_ids', None)
+    if home_ids is None:
+        home_ids = pending_predictions.home_ids = set()
+    home_ids.add(instance.pk if sender is Home else instance.home_id)
+    transaction.on_commit(predict_pending_homes)
+
+
+def predict_pending_homes():
+    # the homes of a rolled back transaction stay pending, and are predicted again after the next one
+    home_ids, pending_predictions.home_ids = getattr(pending_predictions, 'home_ids', set()), set()
+    if home_ids:
+        update_predicted_prices(list(home_ids))
+
+
+@receiver(post_delete, sender=Home)
+def handle_home_deleted(sender, instance, **kwargs):
+    # its location was deleted first, which took care of the tiles and cities
+    record_home_changes([instance.pk])
+    transaction.on_commit(lambda: invalidate_homes([instance.pk], [], [], [instance.type]))
+
+
+@receiver(pre_save, sender=Location)
+def remember_previous_location(sender, instance, **kwargs):
+    instance.previous_location = None
+    if instance.pk is not None:
+        instance.previous_location = sender.objects.filter(pk=instance.pk) \
+            .values_list('coordinates', 'city').first()
+
+
+@receiver(post_save, sender=Location)
+def handle_location_saved(sender, instance, **kwargs):
+    update_search_vectors([instance.home_id])
+    previous_location = getattr(instance, 'previous_location', None)
+    if previous_location is not None:
+        homes_updated([instance.home_id], coordinates=[previous_location[0]], cities=[previous_location[1]])
+    else:
+        homes_updated([instance.home_id])
+
+
+@receiver(post_delete, sender=Location)
+def handle_location_deleted(sender, instance, **kwargs):
+    homes_updated([instance.home_id], coordinates=[instance.coordinates], cities=[instance.city])
+
+
+@receiver(post_save, sender=LivingSpace)
+@receiver(post_delete, sender=LivingSpace)
+@receiver(post_save, sender=Features)
+@receiver(post_delete, sender=Features)
+@receiver(post_save, sender=Image)
+@receiver(post_delete, sender=Image)
+def handle_home_part_changed(sender, instance, **kwargs):
+    homes_updated([instance.home_id])
+
+
+@receiver(m2m_changed, sender=Home.favourite_by.through)
+def handle_home_users_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # the home details list who favoured the home
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            touch_homes([instance.pk])
+        elif pk_set:
+            touch_homes(pk_set)
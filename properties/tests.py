@@ -1,3 +1,396 @@
-from django.test import TestCase
+import asyncio
+import os
+import tempfile
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.contrib.gis.geos import Point
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from properties.card_cache import city_generation_key, register_city_filter, registered_city_filters
+from properties.facets import facet_counts
+from properties.filters import filter_homes
+from properties.models import Home, HomeChange, HomeVisit, Location, LivingSpace, Features, Image
+from properties.pagination import SORT_ORDERS, InvalidCursor, encode_cursor, keyset_queryset, paginate_homes
+from properties.prediction_batcher import PredictionBatcher
+from properties.search_index import HomeSearchIndex
+from properties.serializers import HomeCardsSerializer
+from properties.signals import update_search_vectors
+from properties.utils.compiled_model import CompiledPriceModel, export_price_model
+from properties.utils.price_prediction import price_features, price_models, predict_property_price, \
+    predict_property_price_batch, predict_property_price_pandas, predict_property_prices
+from properties.view_counter import ViewCounter
+
+
+def create_home(owner, index, images=2):
+    home = Home.objects.create(price=1000 * (index + 1), area=100 + index, owner=owner, built_year=2000,
+                               views=index, type='AP', state='R', is_pending=False)
+    Location.objects.create(home=home, coordinates=Point(32.2, 35.2), address=f'Street {index}', city='Nablus')
+    LivingSpace.objects.create(home=home, bedrooms=2, bathrooms=1)
+    Features.objects.create(home=home, data=[{'key': 'pool'}, {'key': 'garden'}])
+    for i in range(images):
+        Image.objects.create(home=home, image=f'properties/{owner.id}/{home.id}/images/{i}.jpg')
+    return home
+
+
+class HomeCardsQueryCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = get_user_model().objects.create_user(username='owner', email='owner@maskan.ps',
+                                                         date_of_birth=date(1990, 1, 1),
+                                                         phone_number='+970599000001', password='password')
+
+    def serialize_cards(self):
+        return HomeCardsSerializer(Home.objects.filter(is_pending=False).order_by('-views').for_cards(),
+                                   many=True).data
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        for index in range(3):
+            create_home(self.owner, index)
+        with self.assertNumQueries(2):
+            self.assertEqual(len(self.serialize_cards()), 3)
+
+        for index in range(3, 20):
+            create_home(self.owner, index)
+        with self.assertNumQueries(2):
+            self.assertEqual(len(self.serialize_cards()), 20)
+
+    def test_first_image_matches_unbatched_serializer(self):
+        create_home(self.owner, 0, images=3)
+        create_home(self.owner, 1, images=0)
+        queryset = Home.objects.filter(is_pending=False).order_by('-views')
+        self.assertEqual(self.serialize_cards(), HomeCardsSerializer(queryset, many=True).data)
+
+
+@override_settings(HOMES_SEARCH_INDEX=True)
+class HomeSearchIndexTests(TestCase):
+    SEARCHES = [{}, {'type': 'ho'}, {'city': 'nab'}, {'city': 'jenin'}, {'state': 'sell'}, {'min_price': '3000'},
+                {'max_price': '6000', 'min_area': '102'}, {'bedrooms': '2'}, {'bedrooms': '5'}, {'bathrooms': '1'},
+                {'features': 'Pool'}, {'features': 'pool,sauna'}, {'features': 'pool,sauna', 'features_match': 'all'},
+                {'features': 'unknown', 'features_match': 'all'}]
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = get_user_model().objects.create_user(username='owner', email='owner@maskan.ps',
+                                                         date_of_birth=date(1990, 1, 1),
+                                                         phone_number='+970599000001', password='password')
+        homes = [create_home(cls.owner, index, images=0) for index in range(12)]
+        for home in homes[::3]:
+            Home.objects.filter(pk=home.pk).update(type='HO', state='S', views=5)  # ties on views
+        Location.objects.filter(home__in=homes[1::4]).update(city='Jenin')
+        LivingSpace.objects.filter(home__in=homes[::4]).update(bedrooms=6, bathrooms=3)
+        Features.objects.filter(home__in=homes[::2]).update(data=[{'key': 'sauna'}])
+        LivingSpace.objects.filter(home=homes[5]).delete()
+        Home.objects.filter(pk=homes[7].pk).update(is_pending=True)
+
+    def database_pages(self, params, limit):
+        cursor, pages = None, []
+        while True:
+            homes, cursor = paginate_homes(filter_homes(params), 'views', cursor, limit)
+            pages.append([home.id for home in homes])
+            if cursor is None:
+                return pages
+
+    def index_pages(self, index, params, limit):
+        cursor, pages = None, []
+        while True:
+            home_ids, cursor = index.search(dict(params, cursor=cursor) if cursor else params, limit)
+            pages.append(home_ids)
+            if cursor is None:
+                return pages
+
+    def test_searches_match_the_database(self):
+        index = HomeSearchIndex()
+        index.build()
+        for params in self.SEARCHES:
+            expected = sorted(home.id for home in filter_homes(params))
+            self.assertEqual(sorted(index.ids[index.filter_mask(params)].tolist()), expected, params)
+            for limit in (1, 3, 100):
+                self.assertEqual(self.index_pages(index, params, limit), self.database_pages(params, limit),
+                                 (params, limit))
+
+    def test_a_change_committed_after_a_later_one_is_applied(self):
+        index = HomeSearchIndex()
+        index.build()
+        home = Home.objects.filter(is_pending=False).first()
+        Home.objects.filter(pk=home.pk).update(price=999999)
+        slow_id = HomeChange.objects.create(home_id=home.pk).id
+        HomeChange.objects.filter(id=slow_id).delete()  # not committed yet when the index refreshes
+        HomeChange.objects.create(home_id=home.pk + 1000)
+        index.refresh()
+        self.assertNotIn(home.pk, index.search({'min_price': '999999'}, 10)[0])
+        token = index.change_token()
+
+        HomeChange.objects.create(id=slow_id, home_id=home.pk)
+        index.refresh()
+        self.assertEqual(index.search({'min_price': '999999'}, 10)[0], [home.pk])
+        self.assertNotEqual(index.change_token(), token)
+
+    def test_a_crafted_cursor_is_rejected_like_in_the_database(self):
+        index = HomeSearchIndex()
+        index.build()
+        for values in (['x', 'y'], [None, 1], [1.5, 1], [True, 1], [1, [2]]):
+            cursor = encode_cursor('views', values)
+            with self.assertRaises(InvalidCursor, msg=values):
+                index.search({'cursor': cursor}, 10)
+            with self.assertRaises(InvalidCursor, msg=values):
+                paginate_homes(filter_homes({}), 'views', cursor, 10)
+
+
+class CursorPaginationTests(TestCase):
+    PARAMS = {'distance': {'lat': '32.2', 'lng': '35.2'}, 'relevance': {'q': 'nablus'}}
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = get_user_model().objects.create_user(username='owner', email='owner@maskan.ps',
+                                                     date_of_birth=date(1990, 1, 1),
+                                                     phone_number='+970599000001', password='password')
+        homes = [create_home(owner, index, images=0) for index in range(7)]
+        # ties on every sort order, the id decides between them
+        Home.objects.filter(pk__in=[home.pk for home in homes[:4]]) \
+            .update(views=3, price=5000, area=100, add_date=timezone.now())
+        Home.objects.filter(pk=homes[4].pk).update(description='nablus old city')
+        update_search_vectors([home.pk for home in homes])
+
+    def pages(self, params, sort, limit):
+        cursor, pages = None, []
+        while True:
+            homes, cursor = paginate_homes(filter_homes(params), sort, cursor, limit)
+            pages.append([home.id for home in homes])
+            if cursor is None:
+                return pages
+
+    def test_pages_follow_each_sort_order(self):
+        for sort in SORT_ORDERS:
+            params = self.PARAMS.get(sort, {})
+            expected = [home.id for home in keyset_queryset(filter_homes(params), sort, None)]
+            self.assertEqual(len(expected), 7, sort)
+            for limit in (1, 2, 3, 7):
+                pages = self.pages(params, sort, limit)
+                self.assertEqual([home_id for page in pages for home_id in page], expected, (sort, limit))
+                self.assertTrue(all(len(page) <= limit for page in pages), (sort, limit))
+
+    def test_a_cursor_of_another_order_is_rejected(self):
+        _, cursor = paginate_homes(filter_homes({}), 'views', None, 1)
+        with self.assertRaises(InvalidCursor):
+            paginate_homes(filter_homes({}), 'newest', cursor, 1)
+
+    def test_a_bad_cursor_answers_400(self):
+        for cursor in ('not a cursor', encode_cursor('views', ['x', 'y'])):
+            response = self.client.get('/properties/houses/api/', {'cursor': cursor})
+            self.assertEqual(response.status_code, 400, cursor)
+            self.assertNotIn('ETag', response)
+
+
+class ViewCounterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = get_user_model().objects.create_user(username='owner', email='owner@maskan.ps',
+                                                         date_of_birth=date(1990, 1, 1),
+                                                         phone_number='+970599000001', password='password')
+        cls.homes = [create_home(cls.owner, index, images=0) for index in range(3)]
+
+    def setUp(self):
+        self.counter = ViewCounter()
+        self.counter.flusher = mock.Mock()  # flushed by the tests only
+
+    def views(self):
+        return list(Home.objects.filter(pk__in=[home.pk for home in self.homes]).order_by('pk')
+                    .values_list('views', flat=True))
+
+    def test_flush_adds_the_counted_views(self):
+        for home, count in zip(self.homes, (3, 3, 1)):
+            for _ in range(count):
+                self.counter.add(home.pk, self.owner.pk)
+        self.assertEqual(self.counter.pending(self.homes[0].pk), 3)
+
+        self.counter.flush()
+        self.assertEqual(self.views(), [0 + 3, 1 + 3, 2 + 1])
+        self.assertEqual([self.counter.pending(home.pk) for home in self.homes], [0, 0, 0])
+        self.assertEqual(HomeVisit.objects.filter(user=self.owner).count(), 3)  # the last visit of each home
+
+        self.counter.add(self.homes[2].pk)
+        self.counter.flush()
+        self.assertEqual(self.views(), [3, 4, 4])
+
+    def test_a_failed_flush_keeps_the_views_for_the_next_one(self):
+        self.counter.add(self.homes[0].pk)
+        with mock.patch('properties.view_counter.existing_visits', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.counter.flush()
+        self.assertEqual(self.views(), [0, 1, 2])
+        self.assertEqual(self.counter.pending(self.homes[0].pk), 1)
+
+        self.counter.add(self.homes[0].pk)
+        self.counter.flush()
+        self.assertEqual(self.views(), [2, 1, 2])
+
+
+class HomeDetailsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        owner = get_user_model().objects.create_user(username='owner', email='owner@maskan.ps',
+                                                     date_of_birth=date(1990, 1, 1),
+                                                     phone_number='+970599000001', password='password')
+        cls.home = create_home(owner, 0, images=0)
+
+    def setUp(self):
+        counter = ViewCounter()
+        counter.flusher = mock.Mock()
+        patcher = mock.patch('properties.views.view_counter', counter)
+        self.counter = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_an_unchanged_home_answers_304(self):
+        url = f'/properties/home/{self.home.pk}/'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['views'], 1)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.counter.pending(self.home.pk), 1)  # not counted as a view
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"another"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['views'], 2)
+
+    def test_a_missing_home_has_no_etag(self):
+        response = self.client.get('/properties/home/0/')
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('ETag', response)
+
+
+class FacetCountsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        owner = get_user_model().objects.create_user(username='owner', email='owner@maskan.ps',
+                                                     date_of_birth=date(1990, 1, 1),
+                                                     phone_number='+970599000001', password='password')
+        homes = [create_home(owner, index, images=0) for index in range(4)]
+        Home.objects.filter(pk=homes[0].pk).update(type='HO', state='S', price=150000)
+        LivingSpace.objects.filter(home=homes[0]).update(bedrooms=6)
+        Location.objects.filter(home=homes[1]).update(city='Jenin')
+        LivingSpace.objects.filter(home=homes[2]).delete()
+        Home.objects.filter(pk=homes[3].pk).update(is_pending=True)
+
+    def test_counts_per_facet(self):
+        self.assertEqual(facet_counts(filter_homes({})), {
+            'total': 3,
+            'city': [{'value': 'Jenin', 'count': 1}, {'value': 'Nablus', 'count': 2}],
+            'type': [{'value': 'AP', 'count': 2}, {'value': 'HO', 'count': 1}],
+            'state': [{'value': 'R', 'count': 2}, {'value': 'S', 'count': 1}],
+            'bedrooms': [{'value': '2', 'count': 1}, {'value': '5+', 'count': 1}],
+            'price': [{'min': 0, 'max': 50000, 'count': 2}, {'min': 100000, 'max': 200000, 'count': 1}],
+        })
+
+    def test_counts_follow_the_filters(self):
+        facets = facet_counts(filter_homes({'city': 'nablus'}))
+        self.assertEqual(facets['total'], 2)
+        self.assertEqual(facets['city'], [{'value': 'Nablus', 'count': 2}])
+
+
+class CityFilterRegistryTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    @mock.patch('properties.card_cache.MAX_CITY_FILTERS', 3)
+    def test_the_last_filters_are_tracked(self):
+        for index in range(10):
+            self.assertTrue(register_city_filter(f'city {index}'))
+        self.assertEqual(registered_city_filters(), {'city 7', 'city 8', 'city 9'})
+
+        generation = cache.get(city_generation_key('city 0'))
+        self.assertTrue(register_city_filter('city 0'))
+        self.assertIn('city 0', registered_city_filters())
+        self.assertEqual(len(registered_city_filters()), 3)
+        self.assertNotEqual(cache.get(city_generation_key('city 0')), generation)  # its changes were not tracked
+
+
+class PricePredictionFastPathTests(SimpleTestCase):
+    def records(self):
+        for city in price_models().ohe.categories_[0]:
+            for home_type in price_models().encoder.classes_:
+                for bedrooms, bathrooms in ((0, 0), (1, 1), (3, 2), (5, 4), (9, 7)):
+                    for area in (0, 1, 250, 1000, 1981, 1982, 3500, 10000, 123457):
+                        yield {'bedrooms': bedrooms, 'bathrooms': bathrooms, 'area': area, 'type': home_type,
+                               'city': city}
+
+    def test_matches_the_pandas_pipeline_bit_for_bit(self):
+        records = list(self.records())
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)  # DataFrame.append
+            expected = [predict_property_price_pandas(record)['predicted_price'] for record in records]
+        for record, price in zip(records, expected):
+            self.assertEqual(predict_property_price(record)['predicted_price'].tobytes(), price.tobytes(), record)
+        self.assertEqual(predict_property_prices(records).tobytes(), np.array(expected).tobytes())
+
+    def test_unknown_city_is_rejected(self):
+        with self.assertRaises(ValueError):
+            predict_property_price({'bedrooms': 2, 'bathrooms': 1, 'area': 100, 'type': 'HOUSE', 'city': 'Nablus'})
+
+
+class PredictPriceApiTests(SimpleTestCase):
+    def record(self):
+        return {'bedrooms': 2, 'bathrooms': 1, 'area': 120, 'type': price_models().encoder.classes_[0],
+                'city': price_models().ohe.categories_[0][0]}
+
+    @override_settings(PRICE_PREDICTION_MAX_BATCH=2)
+    def test_records_are_limited(self):
+        response = self.client.post('/properties/predict_price/', {'records': [self.record()] * 2},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 2)
+
+        response = self.client.post('/properties/predict_price/', {'records': [self.record()] * 3},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_records_should_be_a_list(self):
+        response = self.client.post('/properties/predict_price/', {'records': 'all'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class CompiledPriceModelTests(SimpleTestCase):
+    records = PricePredictionFastPathTests.records
+
+    def test_matches_the_fitted_models_bit_for_bit(self):
+        models = price_models()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'compiled.npz')
+            export_price_model(models, path)
+            compiled = CompiledPriceModel(path, models.version)
+            with self.assertRaises(ValueError):  # compiled from other models
+                CompiledPriceModel(path, 'another version')
+        features = price_features(list(self.records()), models)
+        self.assertEqual(compiled.predict(features).tobytes(), models.predict(features).tobytes())
+
+
+class PredictionBatcherTests(SimpleTestCase):
+    record = {'bedrooms': 3, 'bathrooms': 2, 'area': 1500, 'type': 'HOUSE', 'city': 'Houston'}
+
+    def test_a_cancelled_prediction_does_not_stop_the_worker(self):
+        batcher = PredictionBatcher(window=0.2, max_size=64)
+
+        async def give_up():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(batcher.apredict(self.record), timeout=0.01)
+
+        asyncio.run(give_up())
+        self.assertEqual(batcher.submit(self.record).result(timeout=2), predict_property_price_batch([self.record])[0])
+        self.assertTrue(batcher.worker.is_alive())
+
+    def test_concurrent_predictions_are_coalesced(self):
+        batcher = PredictionBatcher(window=0.5, max_size=64)
+        with ThreadPoolExecutor(16) as pool:
+            results = list(pool.map(batcher.predict, [self.record] * 16))
+        self.assertEqual(results, predict_property_price_batch([self.record]) * 16)
+        self.assertEqual(batcher.stats()['batches'], 1)
+        self.assertEqual(batcher.stats()['recent']['max_size'], 16)
@@ -0,0 +1,100 @@
+import time
+from math import atan, degrees, floor, log, pi, radians, sinh, tan, cos
+
+from django.conf import settings
+from django.db import connection
+
+from properties.caching import cache_is_shared, generations, safe_cache
+from properties.geo import location_bbox
+from properties.models import Home, Location
+
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+MAX_ZOOM = 22
+TILE_LAYER = 'homes'
+MAX_MERCATOR_LAT = 85.0511
+
+
+def tile_bounds(z, x, y, buffer=0):
+    """ (min_lng, min_lat, max_lng, max_lat) of a slippy map tile, grown by `buffer` tile pixels on every side """
+    n = 2 ** z
+    margin = buffer / TILE_EXTENT
+    min_lng = (x - margin) / n * 360 - 180
+    max_lng = (x + 1 + margin) / n * 360 - 180
+    max_lat = degrees(atan(sinh(pi * (1 - 2 * (y - margin) / n))))
+    min_lat = degrees(atan(sinh(pi * (1 - 2 * (y + 1 + margin) / n))))
+    return min_lng, min_lat, max_lng, max_lat
+
+
+def tile_position(lat, lng, z):
+    """ The fractional (x, y) tile coordinates of a point at zoom `z` """
+    n = 2 ** z
+    lat = max(min(lat, MAX_MERCATOR_LAT), -MAX_MERCATOR_LAT)
+    return (lng + 180) / 360 * n, (1 - log(tan(radians(lat)) + 1 / cos(radians(lat))) / pi) / 2 * n
+
+
+def tiles_around(lat, lng, z, buffer=TILE_BUFFER):
+    """ The (x, y) of the tiles at zoom `z` whose bounds, grown by `buffer` tile pixels, contain the point """
+    n = 2 ** z
+    margin = buffer / TILE_EXTENT
+    x, y = tile_position(lat, lng, z)
+    xs = range(max(floor(x - margin), 0), min(floor(x + margin), n - 1) + 1)
+    ys = range(max(floor(y - margin), 0), min(floor(y + margin), n - 1) + 1)
+    return [(tile_x, tile_y) for tile_x in xs for tile_y in ys]
+
+
+def tile_generation_key(z, x, y):
+    return f'tiles:generation:{z}:{x}:{y}'
+
+
+def invalidate_tiles(coordinates):
+    """
+    Drop the cached tiles, for every filter and zoom level, that contain one of the given Location points,
+    counting the TILE_BUFFER that render_tile() includes around them
+    """
+    generation = time.time_ns()
+    keys = {}
+    for point in coordinates:
+        lat, lng = point.x, point.y  # the same axis order as LocationSerializer
+        for z in range(MAX_ZOOM + 1):
+            for x, y in tiles_around(lat, lng, z):
+                keys[tile_generation_key(z, x, y)] = generation
+    safe_cache.set_many(keys, None)
+
+
+def render_tile(queryset, z, x, y):
+    """ Encode the homes of `queryset` inside the tile as a Mapbox vector tile, with ST_AsMVT """
+    bbox = location_bbox(*tile_bounds(z, x, y, buffer=TILE_BUFFER))
+    homes = queryset.filter(location__coordinates__intersects=bbox).order_by().values('id')
+    homes_sql, homes_params = homes.query.sql_with_params()
+    sql = f'''
+        SELECT ST_AsMVT(tile, '{TILE_LAYER}', {TILE_EXTENT}, 'geom') FROM (
+            SELECT home.id, home.price, home.type, home.state,
+                   ST_AsMVTGeom(ST_Transform(ST_FlipCoordinates(location.coordinates), 3857),
+                                ST_TileEnvelope(%s, %s, %s), {TILE_EXTENT}, {TILE_BUFFER}, true) AS geom
+            FROM {Home._meta.db_table} home
+            JOIN {Location._meta.db_table} location ON location.home_id = home.id
+            WHERE home.id IN ({homes_sql})
+        ) AS tile
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [z, x, y, *homes_params])
+        tile = cursor.fetchone()[0]
+    return bytes(tile) if tile is not None else b''
+
+
+def cached_tile(queryset, filter_key, z, x, y):
+    """
+    The tile rendered for the filter set `filter_key`. Cached tiles are keyed on a per-tile generation,
+    replaced by invalidate_tiles() whenever a home inside the tile changes, so every filter variant of it expires.
+    Rendered every time when the cache is not shared by the workers.
+    """
+    if not cache_is_shared():
+        return render_tile(queryset, z, x, y)
+    generation, = generations([tile_generation_key(z, x, y)])
+    key = f'tiles:{filter_key}:{z}:{x}:{y}:{generation}'
+    tile = safe_cache.get(key)
+    if tile is None:
+        tile = render_tile(queryset, z, x, y)
+        safe_cache.set(key, tile, getattr(settings, 'TILES_CACHE_TIMEOUT', 60 * 60))
+    return tile
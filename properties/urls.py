@@ -3,11 +3,15 @@ from django.urls import path
 from properties.views import homes_cards_filtration, home_list, pending_home_list, favourite_home_list, \
     home_images_upload, posted_home_list, home_details, home_not_found, toggle_favorite, visited_home_list, \
     favourite_home_list_api, visited_home_list_api, pending_home_list_api, posted_home_list_api, \
-    homes_cards_filtration_api
+    homes_cards_filtration_api, homes_clusters, homes_tile, homes_facets, properties_metrics, \
+    predict_property_price_api, predict_property_price_one_api
 
 urlpatterns = [
     path("houses/", homes_cards_filtration, name="houses"),
     path("houses/api/", homes_cards_filtration_api, name="houses"),
+    path("houses/clusters/", homes_clusters, name="houses_clusters"),
+    path("houses/facets/", homes_facets, name="houses_facets"),
+    path("tiles/<int:z>/<int:x>/<int:y>.mvt", homes_tile, name="homes_tile"),
     path("home_list/", home_list, name="home_list"),
     path("favourites_home_list/", favourite_home_list, name="favourite_home_list"),
     path("visited_home_list/", visited_home_list, name="visited_home_list"),
@@ -20,5 +24,8 @@ urlpatterns = [
     path("upload/<int:pk>/", home_images_upload, name="upload"),
     path("home/<int:pk>/", home_details, name="home_details"),
     path('home_not_found/', home_not_found, name='home_not_found'),
-    path('home/<int:pk>/toggle_favorite/', toggle_favorite, name='toggle_favorite')
+    path('home/<int:pk>/toggle_favorite/', toggle_favorite, name='toggle_favorite'),
+    path('metrics/', properties_metrics, name='properties_metrics'),
+    path('predict_price/', predict_property_price_api, name='predict_price'),
+    path('predict_price/one/', predict_property_price_one_api, name='predict_price_one'),
 ]
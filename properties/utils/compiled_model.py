@@ -0,0 +1,62 @@
+import numpy as np
+
+COMPILED_MODEL_FILE = 'compiled.npz'
+TREE_LEAF = -1
+
+
+def export_price_model(models, path):
+    """
+    Write the fitted PriceModels as plain arrays: the encoder labels, the one-hot cities, the area scaling and
+    the nodes of the regression tree, flattened, with the version of the models they were compiled from.
+    Loading them back needs NumPy only.
+    """
+    regressor = models.regressor
+    if regressor.n_outputs_ != 1:
+        raise ValueError('Only a single output regression tree can be compiled')
+    tree = regressor.tree_
+    with open(path, 'wb') as f:  # savez would add .npz to a path without it
+        np.savez(f,
+                 version=np.array(models.version),
+                 type_labels=np.array(list(models.type_codes)),
+                 city_labels=np.array(list(models.city_columns)),
+                 area_scaling=np.array([models.area_mean, models.area_scale], dtype=np.float64),
+                 children_left=tree.children_left,
+                 children_right=tree.children_right,
+                 feature=tree.feature,
+                 threshold=tree.threshold,
+                 value=tree.value[:, 0, 0])
+
+
+class CompiledPriceModel:
+    """
+    The price models exported by export_price_model(), with the interface of PriceModels: the category maps
+    of the fast path and predict(). The tree is walked level by level for the whole batch, comparing the
+    float32 features with the float64 thresholds like scikit-learn does, so predictions are the same.
+    Raises ValueError when the arrays were compiled from other models than the `version` expected.
+    """
+
+    def __init__(self, path, version):
+        with np.load(path, allow_pickle=False) as arrays:
+            if str(arrays['version']) != version:
+                raise ValueError(f'{path} was compiled from the models {arrays["version"]}, not {version}')
+            self.type_codes = {label: code for code, label in enumerate(arrays['type_labels'].tolist())}
+            self.city_columns = {city: 4 + column for column, city in enumerate(arrays['city_labels'].tolist())}
+            self.area_mean, self.area_scale = arrays['area_scaling']
+            self.children_left = arrays['children_left']
+            self.children_right = arrays['children_right']
+            self.feature = arrays['feature']
+            self.threshold = arrays['threshold']
+            self.value = arrays['value']
+        self.n_features = 4 + len(self.city_columns)
+        self.version = version
+
+    def predict(self, features):
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        nodes = np.zeros(len(features), dtype=np.intp)
+        rows = np.flatnonzero(self.children_left[nodes] != TREE_LEAF)
+        while len(rows):
+            at = nodes[rows]
+            left = features[rows, self.feature[at]] <= self.threshold[at]
+            nodes[rows] = np.where(left, self.children_left[at], self.children_right[at])
+            rows = rows[self.children_left[nodes[rows]] != TREE_LEAF]
+        return self.value[nodes]
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime, timezone
+
+from properties.utils.compiled_model import COMPILED_MODEL_FILE
+
+MODEL_FILES = ('encoder.sav', 'ohe.sav', 'scaler.sav', 'regressor.sav')
+MANIFEST = 'manifest.json'
+CURRENT = 'CURRENT'  # the pointer to the live version
+SHADOW = 'SHADOW'  # the pointer to the candidate version run alongside it
+
+
+def model_version(model_files_dir):
+    """ A hash of the saved models, stored next to the predictions they made """
+    digest = hashlib.sha256()
+    for name in MODEL_FILES:
+        with open(os.path.join(model_files_dir, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def file_sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class ModelRegistry:
+    """
+    Versions of the price models side by side under `root`, a directory per version holding the model files
+    and a manifest, with the CURRENT and SHADOW files naming the live and the candidate version. Versions are
+    published and pointers moved with atomic renames, so a reader never sees a half written one. The hash of
+    the compiled model of a version, see properties.utils.compiled_model, is added to its manifest once exported.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, version):
+        return os.path.join(self.root, version)
+
+    def versions(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root) if os.path.isfile(os.path.join(self.root, name, MANIFEST)))
+
+    def manifest(self, version):
+        with open(os.path.join(self.path(version), MANIFEST)) as f:
+            return json.load(f)
+
+    def verify(self, version, compiled=False):
+        """
+        Raise ValueError unless the files of the version, and with `compiled` its compiled model, are the ones
+        its manifest was written for
+        """
+        manifest = self.manifest(version)
+        if model_version(self.path(version)) != manifest['sha256']:
+            raise ValueError(f'The model files of version {version} do not match its manifest')
+        if compiled:
+            if 'compiled_sha256' not in manifest:
+                raise ValueError(f'Version {version} is not compiled, run manage.py export_price_model --version '
+                                 f'{version} first')
+            if file_sha256(os.path.join(self.path(version), COMPILED_MODEL_FILE)) != manifest['compiled_sha256']:
+                raise ValueError(f'The compiled model of version {version} does not match its manifest')
+        return manifest
+
+    def record_compiled(self, version):
+        """ Add the hash of the compiled model of the version to its manifest """
+        manifest = self.verify(version)
+        manifest['compiled_sha256'] = file_sha256(os.path.join(self.path(version), COMPILED_MODEL_FILE))
+        path = os.path.join(self.path(version), MANIFEST)
+        staging = f'{path}.{os.getpid()}.tmp'
+        with open(staging, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(staging, path)
+        return manifest
+
+    def publish(self, source_dir, version, description=''):
+        if os.sep in version or version.startswith('.') or not version:
+            raise ValueError(f'Invalid version name: {version}')
+        if os.path.exists(self.path(version)):
+            raise ValueError(f'Version {version} already exists')
+        os.makedirs(self.root, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix='.publishing-', dir=self.root)
+        try:
+            for name in MODEL_FILES:
+                shutil.copyfile(os.path.join(source_dir, name), os.path.join(staging, name))
+            manifest = {
+                'version': version,
+                'files': list(MODEL_FILES),
+                'sha256': model_version(staging),
+                'published_at': datetime.now(timezone.utc).isoformat(),
+                'description': description,
+            }
+            with open(os.path.join(staging, MANIFEST), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.chmod(staging, 0o755)  # mkdtemp makes it private to the publishing user
+            os.rename(staging, self.path(version))
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        return manifest
+
+    def pointer(self, name):
+        try:
+            with open(os.path.join(self.root, name)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def set_pointer(self, name, version, compiled=False):
+        """
+        Point CURRENT or SHADOW at the version, or remove the pointer when it is None. With `compiled`, the
+        version must have a verified compiled model.
+        """
+        path = os.path.join(self.root, name)
+        if version is None:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        self.verify(version, compiled)
+        staging = f'{path}.{os.getpid()}.tmp'
+        with open(staging, 'w') as f:
+            f.write(version)
+        os.replace(staging, path)
+
+    def current(self):
+        return self.pointer(CURRENT)
+
+    def shadow(self):
+        return self.pointer(SHADOW)
@@ -1,17 +1,143 @@
+import logging
 import os
+import queue
+import threading
+import time
+from collections import OrderedDict
 
-import pandas as pd
 import numpy as np
 import joblib
-import sklearn
+from django.conf import settings
+
+from properties.utils.compiled_model import COMPILED_MODEL_FILE, CompiledPriceModel
+from properties.utils.model_registry import ModelRegistry, model_version
+
+logger = logging.getLogger(__name__)
 
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 MODEL_FILES_DIR = os.path.join(BASE_DIR, 'utils')
-# load saved models
-encoder = joblib.load(os.path.join(MODEL_FILES_DIR, 'encoder.sav'))
-ohe = joblib.load(os.path.join(MODEL_FILES_DIR, 'ohe.sav'))
-scaler = joblib.load(os.path.join(MODEL_FILES_DIR, 'scaler.sav'))
-regressor = joblib.load(os.path.join(MODEL_FILES_DIR, 'regressor.sav'))
+
+
+class PriceModels:
+    """
+    The saved models, with the category maps of the fast path taken from them. The tree of the regressor copies
+    its node arrays when it is unpickled, so memory mapping does not share them between processes; workers
+    only share the models when PRICE_MODELS_PRELOAD loads them before a preloading server forks them.
+    """
+
+    def __init__(self, model_files_dir=MODEL_FILES_DIR, version=None, mmap_mode='r'):
+        def load(name):
+            return joblib.load(os.path.join(model_files_dir, name), mmap_mode=mmap_mode)
+
+        self.version = version or model_version(model_files_dir)
+
+        # load saved models
+        self.encoder = load('encoder.sav')
+        self.ohe = load('ohe.sav')
+        self.scaler = load('scaler.sav')
+        self.regressor = load('regressor.sav')
+
+        # the feature matrix columns: bedrooms, bathrooms, area, type, then the one-hot cities, in the order of
+        # regressor.feature_names_in_
+        self.type_codes = {label: code for code, label in enumerate(self.encoder.classes_)}
+        self.city_columns = {city: 4 + column for column, city in enumerate(self.ohe.categories_[0])}
+        self.n_features = 4 + len(self.city_columns)
+        self.area_mean, self.area_scale = self.scaler.mean_[0], self.scaler.scale_[0]
+
+    def predict(self, features):
+        # what regressor.predict does after validating its input: the tree works on float32 features
+        return self.regressor.tree_.predict(np.ascontiguousarray(features, dtype=np.float32))[:, 0]
+
+
+def model_registry():
+    """ The ModelRegistry at PRICE_MODEL_REGISTRY, or None to serve the models saved next to this module """
+    root = getattr(settings, 'PRICE_MODEL_REGISTRY', None)
+    return ModelRegistry(root) if root else None
+
+
+def compiled_models_enabled():
+    return getattr(settings, 'PRICE_MODELS_COMPILED', False)
+
+
+def models_dir(version, compiled=False):
+    registry = model_registry()
+    if registry is None or version is None:  # no registry, or nothing published yet
+        return MODEL_FILES_DIR
+    registry.verify(version, compiled)
+    return registry.path(version)
+
+
+def load_models(version):
+    """
+    The PriceModels of the version, or its CompiledPriceModel when PRICE_MODELS_COMPILED is set, which
+    predicts the same without importing pandas or scikit-learn, see manage.py export_price_model.
+    """
+    compiled = compiled_models_enabled()
+    model_files_dir = models_dir(version, compiled)
+    if compiled:
+        return CompiledPriceModel(os.path.join(model_files_dir, COMPILED_MODEL_FILE),
+                                  version or model_version(model_files_dir))
+    return PriceModels(model_files_dir, version)
+
+
+_models = None
+_shadow_models = None
+_models_lock = threading.Lock()
+_watcher_pid = None
+
+
+def price_models():
+    """
+    The process wide live PriceModels, loaded on first use so that importing this module stays cheap. Set
+    PRICE_MODELS_PRELOAD to load them in PropertiesConfig.ready(), e.g. in the master of a preloading server.
+    With a registry, every process also watches it to swap to a new live version, see refresh_models().
+    Callers keep the models they got for a whole prediction, so a swap never mixes two versions.
+    """
+    global _models, _watcher_pid
+    if _models is None or (_watcher_pid != os.getpid() and model_registry() is not None):
+        with _models_lock:
+            if _models is None:
+                registry = model_registry()
+                _models = load_models(registry.current() if registry else None)
+            if _watcher_pid != os.getpid() and model_registry() is not None:
+                _watcher_pid = os.getpid()  # threads do not survive a fork, each worker starts its own
+                threading.Thread(target=watch_registry, daemon=True).start()
+    return _models
+
+
+def current_model_version():
+    return price_models().version
+
+
+def refresh_models():
+    """
+    Swap to the live and shadow versions the registry points at, loading them before the swap so that
+    predictions in flight finish with the models they started with.
+    """
+    global _models, _shadow_models
+    registry = model_registry()
+    live, shadow = registry.current(), registry.shadow()
+    if live and live != _models.version:
+        models = load_models(live)
+        _models = models
+        logger.info('Serving the price models %s, the stored predictions are updated by manage.py '
+                    'backfill_predictions', live)
+    if shadow is None or shadow == live:
+        _shadow_models = None
+    elif _shadow_models is None or _shadow_models.version != shadow:
+        _shadow_models = load_models(shadow)
+        logger.info('Shadowing the price models %s with %s', live, shadow)
+
+
+def watch_registry():
+    interval = getattr(settings, 'PRICE_MODEL_REGISTRY_POLL', 30)
+    while True:
+        try:
+            refresh_models()
+        except Exception:
+            logger.exception('Refreshing the price models from the registry failed')
+        time.sleep(interval)
+
 
 # def predict_property_price(record):
 #     # convert record dict to df
@@ -36,7 +162,254 @@ regressor = joblib.load(os.path.join(MODEL_FILES_DIR, 'regressor.sav'))
 #     return {'predicted_price': y_predicted[0]}
 
 
+def price_features(records, models=None):
+    """
+    The feature matrix of the records, built straight into one preallocated array with the same values as
+    the encoder, ohe and scaler transforms. Raises ValueError on a type or city the models were not fitted on.
+    """
+    models = models or price_models()
+    features = np.zeros((len(records), models.n_features), dtype=np.float64)
+    for row, record in enumerate(records):
+        if record['type'] not in models.type_codes:
+            raise ValueError(f'Unknown type: {record["type"]}, should be one of {", ".join(models.type_codes)}')
+        if record['city'] not in models.city_columns:
+            raise ValueError(f'Unknown city: {record["city"]}, should be one of {", ".join(models.city_columns)}')
+        features[row, 0] = record['bedrooms']
+        features[row, 1] = record['bathrooms']
+        features[row, 2] = record['area']
+        features[row, 3] = models.type_codes[record['type']]
+        features[row, models.city_columns[record['city']]] = 1
+    features[:, 2] = (features[:, 2] - models.area_mean) / models.area_scale
+    return features
+
+
+def predict_features(features, models=None):
+    return (models or price_models()).predict(features)
+
+
+class PredictionCache:
+    """
+    A bounded LRU memo of the predicted prices by model version and normalized record. With an area bucket,
+    areas are rounded to a multiple of it before predicting, so that close areas share their prediction.
+    """
+
+    def __init__(self, max_size, area_bucket=0):
+        self.max_size = max_size
+        self.area_bucket = area_bucket
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def normalize(self, record):
+        area = record['area']
+        if self.area_bucket:
+            area = round(area / self.area_bucket) * self.area_bucket
+        return {'bedrooms': float(record['bedrooms']), 'bathrooms': float(record['bathrooms']), 'area': float(area),
+                'type': record['type'], 'city': record['city']}
+
+    def predict(self, records, models):
+        """ The predicted prices of the records, as an array, only running the models on the new ones """
+        records = [self.normalize(record) for record in records]
+        keys = [(models.version, record['bedrooms'], record['bathrooms'], record['area'], record['type'],
+                 record['city']) for record in records]
+        prices = np.empty(len(records), dtype=np.float64)
+        missing = []
+        with self.lock:
+            for index, key in enumerate(keys):
+                price = self.entries.get(key)
+                if price is None:
+                    missing.append(index)
+                else:
+                    self.entries.move_to_end(key)
+                    prices[index] = price
+            self.hits += len(records) - len(missing)
+            self.misses += len(missing)
+        if missing:
+            prices[missing] = predict_features(price_features([records[index] for index in missing], models), models)
+            with self.lock:
+                for index in missing:
+                    self.entries[keys[index]] = prices[index]
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        return prices
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'max_size': self.max_size, 'area_bucket': self.area_bucket,
+                    'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else None}
+
+
+_cache = None
+
+
+def prediction_cache():
+    """
+    The process wide PredictionCache of PRICE_PREDICTION_CACHE_SIZE entries (0 disables it), bucketing areas
+    by PRICE_PREDICTION_AREA_BUCKET when set
+    """
+    global _cache
+    if _cache is None:
+        with _models_lock:
+            if _cache is None:
+                _cache = PredictionCache(getattr(settings, 'PRICE_PREDICTION_CACHE_SIZE', 4096),
+                                         getattr(settings, 'PRICE_PREDICTION_AREA_BUCKET', 0))
+    return _cache
+
+
+class ShadowComparison:
+    """
+    Run the shadow models on the records predicted by the live ones, on a background thread so that serving
+    does not wait for them, and compare the predictions, the time per record and, for the records carrying
+    their listing `price`, the mean absolute errors of both versions.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=100)
+        self.lock = threading.Lock()
+        self.worker = None
+        self.reset(None, None)
+
+    def reset(self, live_version, shadow_version):
+        self.versions = (live_version, shadow_version)
+        self.records = self.dropped = self.rejected = self.priced = 0
+        self.abs_diff = self.max_abs_diff = self.live_seconds = self.shadow_seconds = 0.0
+        self.live_abs_error = self.shadow_abs_error = 0.0
+
+    def submit(self, records, live, shadow):
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, daemon=True)
+                self.worker.start()
+        try:
+            self.queue.put_nowait((records, live, shadow))
+        except queue.Full:  # shadowing must not slow serving down, skip what it cannot keep up with
+            with self.lock:
+                self.dropped += len(records)
+
+    def run(self):
+        while True:
+            records, live, shadow = self.queue.get()
+            try:
+                self.compare(records, live, shadow)
+            except Exception:
+                logger.exception('Comparing the price models %s and %s failed', live.version, shadow.version)
+
+    def compare(self, records, live, shadow):
+        valid = [record for record in records if not validate_record(record, shadow)]
+        started = time.perf_counter()
+        live_prices = predict_features(price_features(valid, live), live) if valid else np.empty(0)
+        live_done = time.perf_counter()
+        shadow_prices = predict_features(price_features(valid, shadow), shadow) if valid else np.empty(0)
+        shadow_done = time.perf_counter()
+        diffs = np.abs(live_prices - shadow_prices)
+        listed = [(index, record['price']) for index, record in enumerate(valid) if record.get('price')]
+        with self.lock:
+            if self.versions != (live.version, shadow.version):
+                self.reset(live.version, shadow.version)
+            self.rejected += len(records) - len(valid)
+            self.records += len(valid)
+            self.abs_diff += float(diffs.sum())
+            self.max_abs_diff = max(self.max_abs_diff, float(diffs.max(initial=0)))
+            self.live_seconds += live_done - started
+            self.shadow_seconds += shadow_done - live_done
+            self.priced += len(listed)
+            for index, price in listed:
+                self.live_abs_error += abs(float(live_prices[index]) - price)
+                self.shadow_abs_error += abs(float(shadow_prices[index]) - price)
+
+    def stats(self):
+        with self.lock:
+            records, priced = self.records, self.priced
+            return {
+                'live': self.versions[0],
+                'shadow': self.versions[1],
+                'records': records,
+                'dropped': self.dropped,
+                'rejected_by_shadow': self.rejected,
+                'mean_abs_diff': self.abs_diff / records if records else None,
+                'max_abs_diff': self.max_abs_diff,
+                'live_us_per_record': self.live_seconds / records * 1e6 if records else None,
+                'shadow_us_per_record': self.shadow_seconds / records * 1e6 if records else None,
+                'with_listing_price': priced,
+                'live_mae': self.live_abs_error / priced if priced else None,
+                'shadow_mae': self.shadow_abs_error / priced if priced else None,
+            }
+
+
+shadow_comparison = ShadowComparison()
+
+
+def price_models_stats():
+    stats = {'live': _models and _models.version, 'shadow': _shadow_models and _shadow_models.version}
+    if shadow_comparison.records or _shadow_models:
+        stats['shadow_comparison'] = shadow_comparison.stats()
+    return stats
+
+
+def predict_property_prices(records, models=None):
+    """ The predicted prices of a batch of records, as an array """
+    models = models or price_models()
+    cache = prediction_cache()
+    if cache.max_size:
+        prices = cache.predict(records, models)
+    else:
+        prices = predict_features(price_features(records, models), models)
+    shadow = _shadow_models
+    if shadow is not None:
+        shadow_comparison.submit(records, models, shadow)
+    return prices
+
+
 def predict_property_price(record):
+    return {'predicted_price': predict_property_prices([record])[0]}
+
+
+def validate_record(record, models=None):
+    """ The errors of the record by field, empty when the models can price it """
+    if not isinstance(record, dict):
+        return {'record': 'should be an object with bedrooms, bathrooms, area, type and city'}
+    models = models or price_models()
+    errors = {}
+    for name in ('bedrooms', 'bathrooms', 'area'):
+        value = record.get(name)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value < float('inf'):
+            errors[name] = 'should be a non-negative number'
+    if record.get('type') not in models.type_codes:
+        errors['type'] = f'should be one of {", ".join(models.type_codes)}'
+    if record.get('city') not in models.city_columns:
+        errors['city'] = f'should be one of {", ".join(models.city_columns)}'
+    return errors
+
+
+def predict_property_price_batch(records, models=None):
+    """
+    Predict the prices of many records with one vectorized prediction over the valid ones. Returns, for every
+    record in order, either {'predicted_price': price} or {'errors': {field: message}}.
+    """
+    models = models or price_models()
+    results = [None] * len(records)
+    valid = []
+    for index, record in enumerate(records):
+        errors = validate_record(record, models)
+        if errors:
+            results[index] = {'errors': errors}
+        else:
+            valid.append(index)
+    if valid:
+        prices = predict_property_prices([records[index] for index in valid], models)
+        for index, price in zip(valid, prices):
+            results[index] = {'predicted_price': float(price)}
+    return results
+
+
+def predict_property_price_pandas(record):
+    """ The original pandas pipeline, the reference of the fast path above """
+    import pandas as pd  # only needed here, importing it costs every worker
+
+    models = price_models()
+    encoder, ohe, scaler, regressor = models.encoder, models.ohe, models.scaler, models.regressor
     # convert record dict to df
     house_record = pd.DataFrame().append(record, ignore_index=True)
 
@@ -0,0 +1,125 @@
+import atexit
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections, transaction
+from django.db.models import F, Max
+from django.utils import timezone
+
+from properties.card_cache import invalidate_card_fragments, invalidate_views
+from properties.models import Home, HomeVisit
+from properties.search_index import record_home_changes
+
+logger = logging.getLogger(__name__)
+
+
+class ViewCounter:
+    """
+    Home views counted in memory and written behind every HOME_VIEWS_FLUSH_INTERVAL seconds, with one
+    `views = views + n` UPDATE per distinct n, so that reading a home never writes its row. The visits of
+    signed in users are logged to HomeVisit in the same flush, keeping the last HOME_VISITS_PER_USER homes per user.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.counts = Counter()
+        self.flushing = Counter()  # taken by the running flush, not written yet
+        self.visits = []
+        self.flusher = None
+
+    def add(self, home_id, user_id=None):
+        with self.lock:
+            self.counts[home_id] += 1
+            if user_id is not None:
+                self.visits.append(HomeVisit(user_id=user_id, home_id=home_id, visited_at=timezone.now()))
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.keep_flushing, daemon=True)
+                self.flusher.start()
+
+    def pending(self, home_id):
+        """ The views of the home counted by this process but not written yet """
+        with self.lock:
+            return self.counts.get(home_id, 0) + self.flushing.get(home_id, 0)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                counts, self.counts = self.counts, Counter()
+                visits, self.visits = self.visits, []
+                self.flushing = counts
+            if not counts:
+                return
+            by_views = defaultdict(list)
+            for home_id, views in counts.items():
+                by_views[views].append(home_id)
+            try:
+                with transaction.atomic():
+                    for views, home_ids in by_views.items():
+                        Home.objects.filter(pk__in=home_ids).update(views=F('views') + views)
+                    visits = existing_visits(visits)
+                    HomeVisit.objects.bulk_create(visits)
+                    trim_visits({visit.user_id for visit in visits})
+            except Exception:
+                with self.lock:
+                    self.counts.update(counts)  # retried by the next flush
+                    self.visits[:0] = visits
+                raise
+            finally:
+                with self.lock:
+                    self.flushing = Counter()
+            # the cards show the views, and the default order is by views
+            invalidate_card_fragments(list(counts))
+            invalidate_views()
+            record_home_changes(list(counts))
+
+    def keep_flushing(self):
+        interval = getattr(settings, 'HOME_VIEWS_FLUSH_INTERVAL', 5)
+        while True:
+            time.sleep(interval)
+            try:
+                close_old_connections()
+                self.flush()
+            except Exception:
+                logger.exception('Flushing the home views failed')
+
+
+def existing_visits(visits):
+    """
+    The visits whose home and user still exist, the others would fail the foreign keys on every retry. The
+    homes were locked by updating their views, the users are locked here until the visits are written.
+    """
+    home_ids = set(Home.objects.filter(pk__in={visit.home_id for visit in visits}).values_list('id', flat=True))
+    user_ids = set(get_user_model().objects.select_for_update(no_key=True).order_by('pk')
+                   .filter(pk__in={visit.user_id for visit in visits}).values_list('id', flat=True))
+    return [visit for visit in visits if visit.home_id in home_ids and visit.user_id in user_ids]
+
+
+def trim_visits(user_ids):
+    """
+    Keep the last visit of the last HOME_VISITS_PER_USER homes each of the given users visited, deleting their
+    older visits of the same homes and the visits of the other homes
+    """
+    keep = getattr(settings, 'HOME_VISITS_PER_USER', 100)
+    for user_id in user_ids:
+        visits = HomeVisit.objects.filter(user_id=user_id)
+        recent_homes = visits.values('home_id').annotate(last_visit=Max('visited_at')) \
+            .order_by('-last_visit', '-home_id').values_list('home_id', flat=True)[:keep]
+        visits.exclude(home_id__in=list(recent_homes)).delete()
+        last_visits = visits.order_by('home_id', '-visited_at', '-id').distinct('home_id').values('id')
+        visits.exclude(id__in=last_visits).delete()
+
+
+view_counter = ViewCounter()
+
+
+@atexit.register
+def flush_views():
+    try:
+        view_counter.flush()
+    except Exception:
+        logger.exception('Flushing the home views on exit failed')
@@ -1,119 +1,208 @@
-from functools import reduce
+import json
+from functools import wraps
+from itertools import islice
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.db import transaction
-from django.db.models import Q
-from django.http import JsonResponse
+from django.db.models import Max
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 from rest_framework.decorators import api_view, parser_classes
 from rest_framework.parsers import MultiPartParser, FormParser
 
 from notifications.models import home_favourite
-from properties.models import Home, Features
-from properties.serializers import HomeCardsSerializer, HomeSerializer, \
-    HomeImageAndOwnershipUploadSerializer, HomeRepresentationSerializer
-from properties.utils.price_prediction import predict_property_price
+from properties.card_cache import cached_cards_page, card_cache_stats, cards_json, card_fragments, cards_etag
+from properties.clusters import cluster_homes
+from properties.facets import cached_facet_counts
+from properties.filters import filter_homes, search_sort, normalized_filter_key
+from properties.models import Home
+from properties.pagination import paginate_homes, keyset_queryset, cursor_after
+from properties.prediction_batcher import prediction_batcher
+from properties.search_index import search_index
+from properties.serializers import HomeSerializer, HomeImageAndOwnershipUploadSerializer, \
+    HomeRepresentationSerializer
+from properties.tiles import cached_tile, MAX_ZOOM
+from properties.view_counter import view_counter
+from properties.utils.price_prediction import predict_property_price_batch, prediction_cache, price_models_stats
 
 
 # Create your views here.
-@api_view(['GET'])
-def homes_cards_filtration(request):
-    if request.method == 'GET':
-        limit = int(request.GET.get('limit', 100))
-        type_filter = request.GET.get('type')  # AP or HO
-        city_filter = request.GET.get('city')
-        state_filter = request.GET.get('state')  # S or R
-        min_price = int(request.GET.get('min_price', 0))
-        max_price = int(request.GET.get('max_price', 1000000000))
-        min_area = int(request.GET.get('min_area', 0))
-        max_area = int(request.GET.get('max_area', 1000000))
-        bedrooms = int(request.GET.get('bedrooms', '0'))
-        bathrooms = int(request.GET.get('bathrooms', '0'))
-
-        queryset = Home.objects.filter(is_pending=False).order_by('-views')
-        if type_filter and type_filter != '':
-            queryset = queryset.filter(type__iexact=type_filter)
-        if city_filter and city_filter != '':
-            queryset = queryset.filter(location__city__icontains=city_filter)
-        if state_filter and state_filter != '':
-            queryset = queryset.filter(state__iexact=state_filter.upper()[0:1])
-        queryset = queryset.filter(price__range=(min_price, max_price))
-        queryset = queryset.filter(area__range=(min_area, max_area))
-        if bedrooms and bedrooms != 0:
-            if bedrooms >= 5:
-                queryset = queryset.filter(living_space__bedrooms__gte=bedrooms)
-            else:
-                queryset = queryset.filter(living_space__bedrooms__exact=bedrooms)
+CARD_SORT_FIELDS = ('id', 'views', 'price', 'area', 'add_date')
+
+
+def homes_cards_limit(params, default):
+    """ The requested page size, capped by HOUSES_MAX_LIMIT, or HOUSES_MAX_STREAM_LIMIT when streaming """
+    limit = int(params.get('limit', default))
+    if limit < 0:
+        raise ValueError(f'Invalid limit: {limit}')
+    if params.get('stream'):
+        return min(limit, getattr(settings, 'HOUSES_MAX_STREAM_LIMIT', 10000))
+    return min(limit, getattr(settings, 'HOUSES_MAX_LIMIT', 500))
+
+
+def homes_cards_page(params, limit):
+    """
+    Filter, sort and paginate the approved homes for the houses search endpoints, returning the ids of the homes
+    in the page and the cursor of the next page. Searches the in-process index when HOMES_SEARCH_INDEX is
+    enabled and it can answer them. Raises ValueError on invalid parameters.
+    """
+    index = search_index()
+    if index is not None:
+        page = index.search(params, limit)
+        if page is not None:
+            return page
+    sort = search_sort(params)
+    queryset = filter_homes(params).only(*CARD_SORT_FIELDS)
+    homes, next_cursor = paginate_homes(queryset, sort, params.get('cursor'), limit)
+    return [home.id for home in homes], next_cursor
+
+
+def cards_response(home_ids):
+    return HttpResponse(cards_json(home_ids), content_type='application/json')
+
+
+def homes_cards_response(request, home_ids, next_cursor):
+    """
+    Clients page through the houses search with the opaque `cursor` parameter; passing it (empty for the first
+    page) wraps the cards in {"results": [...], "next": <cursor or null>}.
+    """
+    if 'cursor' in request.GET:
+        body = b'{"results": ' + cards_json(home_ids) + b', "next": ' + json.dumps(next_cursor).encode() + b'}'
+        return HttpResponse(body, content_type='application/json')
+    return cards_response(home_ids)
+
+
+def homes_cards_stream(queryset, sort, limit, envelope):
+    """
+    Write the cards of the first `limit` homes of the sorted `queryset` as they are read from a server side
+    cursor, HOUSES_STREAM_CHUNK_SIZE homes at a time, so memory use does not grow with the limit.
+    """
+    chunk_size = getattr(settings, 'HOUSES_STREAM_CHUNK_SIZE', 200)
+    yield b'{"results": [' if envelope else b'['
+    homes = queryset[:limit + 1].iterator(chunk_size=chunk_size)  # one extra row tells if there is a next page
+    sent, last_home, has_next, separator = 0, None, False, b''
+    while True:
+        chunk = list(islice(homes, chunk_size))
+        if sent + len(chunk) > limit:
+            chunk, has_next = chunk[:limit - sent], True
+        fragments = card_fragments([home.id for home in chunk])
+        if fragments:
+            yield separator + b', '.join(fragments)
+            separator = b', '
+        if chunk:
+            sent, last_home = sent + len(chunk), chunk[-1]
+        if has_next or len(chunk) < chunk_size:
+            break
+    if envelope:
+        next_cursor = cursor_after(last_home, sort) if has_next and last_home is not None else None
+        yield b'], "next": ' + json.dumps(next_cursor).encode() + b'}'
+    else:
+        yield b']'
 
-        if bathrooms and bathrooms != 0:
-            if bathrooms >= 5:
-                queryset = queryset.filter(living_space__bathrooms__gte=bathrooms)
-            else:
-                queryset = queryset.filter(living_space__bathrooms__exact=bathrooms)
-        keys = request.GET.get('features', None)
-        if keys:
-            keys = keys.split(',')
-            if len(keys) > 0:
-                queries = [Q(data__icontains=f'{{"key": "{key.lower()}"}}') for key in keys]
-                query = reduce(lambda q1, q2: q1 | q2, queries)
-                queryset2 = Features.objects.filter(query)
-                # queries = [Q(data={'key': f'{key.lower()}'}) for key in keys]
-                # query = reduce(lambda q1, q2: q1 | q2, queries)
-                # queryset2 = Features.objects.filter(query)
-                feature_ids = [f.home_id for f in queryset2]
-                queryset = queryset.filter(pk__in=feature_ids)
-        if (len(queryset)) > 0:
-            serializer = HomeCardsSerializer(queryset[:limit], many=True)
+
+def homes_cards_list(request, default_limit, no_content):
+    """
+    The houses search response, streamed when `stream` is given. With `no_content`, a search without
+    results answers 204.
+    """
+    try:
+        limit = homes_cards_limit(request.GET, default_limit)
+        if request.GET.get('stream'):
+            sort = search_sort(request.GET)
+            queryset = keyset_queryset(filter_homes(request.GET).only(*CARD_SORT_FIELDS), sort,
+                                       request.GET.get('cursor'))
         else:
+            home_ids, next_cursor = cached_cards_page(request.GET, limit, homes_cards_page)
+    except ValueError as e:
+        return JsonResponse({"Bad Request": str(e)}, status=400)
+
+    if request.GET.get('stream'):
+        if no_content and not queryset.exists():
             return JsonResponse({"No Content": "No homes."}, status=204)
-        return JsonResponse(serializer.data, safe=False)
+        return StreamingHttpResponse(homes_cards_stream(queryset, sort, limit, 'cursor' in request.GET),
+                                     content_type='application/json')
+    if no_content and len(home_ids) == 0:
+        return JsonResponse({"No Content": "No homes."}, status=204)
+    return homes_cards_response(request, home_ids, next_cursor)
+
+
+def homes_cards_etag(request):
+    return cards_etag(request.GET)
+
 
+def validators_on_success(view):
+    """ Keep the ETag that condition() adds to every response only on the 200 and 304 ones """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        if response.status_code not in (200, 304) and response.has_header('ETag'):
+            del response['ETag']
+        return response
+    return wrapper
 
+
+@validators_on_success
+@condition(etag_func=homes_cards_etag)
+@api_view(['GET'])
+def homes_cards_filtration(request):
+    if request.method == 'GET':
+        return homes_cards_list(request, 100, no_content=True)
+
+
+@validators_on_success
+@condition(etag_func=homes_cards_etag)
 @api_view(['GET'])
 def homes_cards_filtration_api(request):
     if request.method == 'GET':
-        limit = int(request.GET.get('limit', 30))
-        type_filter = request.GET.get('type')  # AP or HO
-        city_filter = request.GET.get('city')
-        state_filter = request.GET.get('state')  # S or R
-        min_price = int(request.GET.get('min_price', 0))
-        max_price = int(request.GET.get('max_price', 1000000000))
-        min_area = int(request.GET.get('min_area', 0))
-        max_area = int(request.GET.get('max_area', 1000000))
-        bedrooms = int(request.GET.get('bedrooms', '0'))
-        bathrooms = int(request.GET.get('bathrooms', '0'))
-
-        queryset = Home.objects.filter(is_pending=False).order_by('-views')
-        if type_filter and type_filter != '':
-            queryset = queryset.filter(type__iexact=type_filter)
-        if city_filter and city_filter != '':
-            queryset = queryset.filter(location__city__icontains=city_filter)
-        if state_filter and state_filter != '':
-            queryset = queryset.filter(state__iexact=state_filter.upper()[0:1])
-        queryset = queryset.filter(price__range=(min_price, max_price))
-        queryset = queryset.filter(area__range=(min_area, max_area))
-        if bedrooms and bedrooms != 0:
-            if bedrooms >= 5:
-                queryset = queryset.filter(living_space__bedrooms__gte=bedrooms)
-            else:
-                queryset = queryset.filter(living_space__bedrooms__exact=bedrooms)
+        return homes_cards_list(request, 30, no_content=False)
 
-        if bathrooms and bathrooms != 0:
-            if bathrooms >= 5:
-                queryset = queryset.filter(living_space__bathrooms__gte=bathrooms)
-            else:
-                queryset = queryset.filter(living_space__bathrooms__exact=bathrooms)
-        keys = request.GET.get('features', None)
-        if keys:
-            keys = keys.split(',')
-            if len(keys) > 0:
-                queries = [Q(data__icontains=f'{{"key": "{key.lower()}"}}') for key in keys]
-                query = reduce(lambda q1, q2: q1 | q2, queries)
-                queryset2 = Features.objects.filter(query)
-                feature_ids = [f.home_id for f in queryset2]
-                queryset = queryset.filter(pk__in=feature_ids)
-        serializer = HomeCardsSerializer(queryset[:limit], many=True)
-        return JsonResponse(serializer.data, safe=False)
+
+@api_view(['GET'])
+def homes_clusters(request):
+    """
+    Map markers for the `bbox=min_lng,min_lat,max_lng,max_lat` viewport at the given `zoom` level, honouring the
+    same filters as the houses search: [{"count", "lat", "lng", "min_price", "max_price", "id" (single homes)}].
+    """
+    if request.method == 'GET':
+        bbox = request.GET.get('bbox')
+        zoom = request.GET.get('zoom')
+        if not bbox or zoom is None:
+            return JsonResponse({"Bad Request": "bbox and zoom are required"}, status=400)
+        try:
+            clusters = cluster_homes(filter_homes(request.GET), bbox, zoom)
+        except ValueError as e:
+            return JsonResponse({"Bad Request": str(e)}, status=400)
+        return JsonResponse(clusters, safe=False)
+
+
+@api_view(['GET'])
+def homes_facets(request):
+    """ Counts per city, type, state, bedrooms and price bucket of the homes matching the houses search filters """
+    if request.method == 'GET':
+        try:
+            facets = cached_facet_counts(request.GET)
+        except ValueError as e:
+            return JsonResponse({"Bad Request": str(e)}, status=400)
+        return JsonResponse(facets)
+
+
+@api_view(['GET'])
+def homes_tile(request, z, x, y):
+    """
+    A Mapbox vector tile with a `homes` layer of the approved homes matching the houses search filters,
+    carrying their id, price, type and state.
+    """
+    if request.method == 'GET':
+        if z > MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+            return JsonResponse({"error": f"Tile {z}/{x}/{y} does not exist"}, status=404)
+        try:
+            tile = cached_tile(filter_homes(request.GET), normalized_filter_key(request.GET), z, x, y)
+        except ValueError as e:
+            return JsonResponse({"Bad Request": str(e)}, status=400)
+        return HttpResponse(tile, content_type='application/vnd.mapbox-vector-tile')
 
 
 @csrf_exempt
@@ -150,17 +239,46 @@ def home_list(request):
         return JsonResponse({"Unauthorized": "the user is not authenticated"}, status=401)
 
 
+def home_stamp(request, pk):
+    """ The (version, views, prediction_model_version) of the home, read once per request """
+    if not hasattr(request, 'home_stamp'):
+        request.home_stamp = Home.objects.filter(pk=pk) \
+            .values_list('version', 'views', 'prediction_model_version').first()
+    return request.home_stamp
+
+
+def home_details_etag(pk, version, views, prediction_model_version):
+    # the details also carry the predicted price, backfilled without bumping the version after a model upgrade
+    return f'"{pk}-{version}-{views}-{prediction_model_version}"'
+
+
+def home_etag(request, pk):
+    stamp = home_stamp(request, pk)
+    return home_details_etag(pk, stamp[0], stamp[1] + view_counter.pending(pk), stamp[2]) if stamp else None
+
+
+# no Last-Modified: updated_at does not move with the views, which the details show
+@validators_on_success
+@condition(etag_func=home_etag)
 @api_view(['GET'])
 def home_details(request, pk):
+    """
+    Clients revalidating an unchanged home get a 304, which neither serializes it nor counts a view.
+    Views and visits are written behind by properties.view_counter, the response includes the views not
+    written yet.
+    """
     try:
         home = Home.objects.get(pk=pk)
-        home.views = home.views + 1
+        visitor_id = None
         if request.user.is_authenticated:
             if home.owner != request.user:
-                home.visited_by.add(request.user)
-        home.save()
+                visitor_id = request.user.id
+        view_counter.add(home.pk, visitor_id)
+        home.views = home.views + view_counter.pending(home.pk)
         serializer = HomeRepresentationSerializer(home)
-        return JsonResponse(serializer.data, status=200)
+        response = JsonResponse(serializer.data, status=200)
+        response['ETag'] = home_details_etag(pk, home.version, home.views, home.prediction_model_version)
+        return response
     except Home.DoesNotExist:
         return JsonResponse({"error": "Home does not exist"}, status=404)
 
@@ -171,10 +289,9 @@ def favourite_home_list(request):
         if request.user.is_authenticated:
             try:
                 user = get_object_or_404(get_user_model(), pk=request.user.id)
-                favourites = user.favourites.exclude(owner=user)
+                favourites = list(user.favourites.exclude(owner=user).values_list('id', flat=True))
                 if len(favourites) > 0:
-                    serializer = HomeCardsSerializer(favourites, many=True)
-                    return JsonResponse(serializer.data, safe=False, status=200)
+                    return cards_response(favourites)
                 else:
                     return JsonResponse({"No Content": "the user has no favorite homes."}, status=204)
             except get_user_model().DoesNotExist:
@@ -183,16 +300,21 @@ def favourite_home_list(request):
             return JsonResponse({"Unauthorized": "the user is not authenticated"}, status=401)
 
 
+def visited_home_ids(user):
+    """ The homes of others the user visited, most recent first """
+    return list(user.home_visits.exclude(home__owner=user).values('home_id')
+                .annotate(last_visit=Max('visited_at')).order_by('-last_visit').values_list('home_id', flat=True))
+
+
 @api_view(['GET'])
 def visited_home_list(request):
     if request.method == 'GET':
         if request.user.is_authenticated:
             try:
                 user = get_object_or_404(get_user_model(), pk=request.user.id)
-                visited = user.visited.exclude(owner=user)
+                visited = visited_home_ids(user)
                 if len(visited) > 0:
-                    serializer = HomeCardsSerializer(visited, many=True)
-                    return JsonResponse(serializer.data, safe=False, status=200)
+                    return cards_response(visited)
                 else:
                     return JsonResponse({"No Content": "the user has no visited homes."}, status=204)
             except get_user_model().DoesNotExist:
@@ -208,10 +330,9 @@ def pending_home_list(request):
         if request.user.is_authenticated:
             try:
                 user = get_user_model().objects.get(pk=request.user.id)
-                pending = user.properties.filter(is_pending=True)
+                pending = list(user.properties.filter(is_pending=True).values_list('id', flat=True))
                 if len(pending) > 0:
-                    serializer = HomeCardsSerializer(pending, many=True)
-                    return JsonResponse(serializer.data, safe=False, status=200)
+                    return cards_response(pending)
                 else:
                     return JsonResponse({"No Content": "the user has no pending homes."}, status=204)
             except get_user_model().DoesNotExist:
@@ -226,9 +347,8 @@ def favourite_home_list_api(request):
         if request.user.is_authenticated:
             try:
                 user = get_object_or_404(get_user_model(), pk=request.user.id)
-                favourites = user.favourites.exclude(owner=user)
-                serializer = HomeCardsSerializer(favourites, many=True)
-                return JsonResponse(serializer.data, safe=False, status=200)
+                favourites = list(user.favourites.exclude(owner=user).values_list('id', flat=True))
+                return cards_response(favourites)
             except get_user_model().DoesNotExist:
                 return JsonResponse({"Not Found": "the user with the given ID does not exist"}, status=404)
         else:
@@ -241,9 +361,8 @@ def visited_home_list_api(request):
         if request.user.is_authenticated:
             try:
                 user = get_object_or_404(get_user_model(), pk=request.user.id)
-                visited = user.visited.exclude(owner=user)
-                serializer = HomeCardsSerializer(visited, many=True)
-                return JsonResponse(serializer.data, safe=False, status=200)
+                visited = visited_home_ids(user)
+                return cards_response(visited)
             except get_user_model().DoesNotExist:
                 return JsonResponse({"Not Found": "the user with the given ID does not exist"}, status=404)
         else:
@@ -257,9 +376,8 @@ def pending_home_list_api(request):
         if request.user.is_authenticated:
             try:
                 user = get_user_model().objects.get(pk=request.user.id)
-                pending = user.properties.filter(is_pending=True)
-                serializer = HomeCardsSerializer(pending, many=True)
-                return JsonResponse(serializer.data, safe=False, status=200)
+                pending = list(user.properties.filter(is_pending=True).values_list('id', flat=True))
+                return cards_response(pending)
             except get_user_model().DoesNotExist:
                 return JsonResponse({"Not Found": "the user with the given ID does not exist"}, status=404)
         else:
@@ -272,10 +390,9 @@ def posted_home_list(request):
         if request.user.is_authenticated:
             try:
                 user = get_user_model().objects.get(pk=request.user.id)
-                posted = user.properties.filter(is_pending=False)
+                posted = list(user.properties.filter(is_pending=False).values_list('id', flat=True))
                 if len(posted) > 0:
-                    serializer = HomeCardsSerializer(posted, many=True)
-                    return JsonResponse(serializer.data, safe=False, status=200)
+                    return cards_response(posted)
                 else:
                     return JsonResponse({"No Content": "the user has no pending homes."}, status=204)
             except get_user_model().DoesNotExist:
@@ -290,15 +407,25 @@ def posted_home_list_api(request):
         if request.user.is_authenticated:
             try:
                 user = get_user_model().objects.get(pk=request.user.id)
-                posted = user.properties.filter(is_pending=False)
-                serializer = HomeCardsSerializer(posted, many=True)
-                return JsonResponse(serializer.data, safe=False, status=200)
+                posted = list(user.properties.filter(is_pending=False).values_list('id', flat=True))
+                return cards_response(posted)
             except get_user_model().DoesNotExist:
                 return JsonResponse({"Not Found": "the user with the given ID does not exist"}, status=404)
         else:
             return JsonResponse({"Unauthorized": "the user is not authenticated"}, status=401)
 
 
+@api_view(['GET'])
+def properties_metrics(request):
+    if request.method == 'GET':
+        if request.user.is_authenticated and request.user.is_staff:
+            return JsonResponse({'card_cache': card_cache_stats(),
+                                 'prediction_batches': prediction_batcher().stats(),
+                                 'prediction_cache': prediction_cache().stats(),
+                                 'price_models': price_models_stats()})
+        return JsonResponse({"Forbidden": "only staff users can see the metrics"}, status=403)
+
+
 def home_not_found(request):
     data = {'error': 'Home not found.'}
     return JsonResponse(data, status=404)
@@ -332,18 +459,35 @@ def toggle_favorite(request, pk):
             return JsonResponse({"Unauthorized": "the user is not authenticated"}, status=401)
 
 
+@csrf_exempt
+@api_view(['POST'])
 def predict_property_price_api(request):
+    """
+    Predict the prices of {"records": [{"bedrooms", "bathrooms", "area", "type", "city"}, ...]} in one batch,
+    answering {"results": [{"predicted_price"} or {"errors"}, ...]} in the same order.
+    """
     if request.method == 'POST':
-        record = request.POST.get('record')
-        # Assuming you receive the record data as a JSON string in the 'record' parameter
-
-        # Perform validation and error handling if necessary
-
-        # Call the predict_house_price function
-        prediction = predict_property_price(record)
-
-        # Return the prediction as a JSON response
-        return JsonResponse(prediction)
-    else:
-        # Return an error response for unsupported methods
+        records = request.data.get('records') if isinstance(request.data, dict) else None
+        if not isinstance(records, list):
+            return JsonResponse({"Bad Request": "records should be a list"}, status=400)
+        max_batch = getattr(settings, 'PRICE_PREDICTION_MAX_BATCH', 1000)
+        if len(records) > max_batch:
+            return JsonResponse({"Bad Request": f"at most {max_batch} records can be predicted at once"}, status=400)
+        return JsonResponse({'results': predict_property_price_batch(records)})
+
+
+async def predict_property_price_one_api(request):
+    """
+    Predict the price of one record given as the bedrooms, bathrooms, area, type and city query parameters.
+    Under ASGI, the concurrent requests are answered by one batched prediction, see properties.prediction_batcher.
+    """
+    if request.method != 'GET':
         return JsonResponse({'error': 'Method not allowed'}, status=405)
+    record = {'type': request.GET.get('type'), 'city': request.GET.get('city')}
+    try:
+        for name in ('bedrooms', 'bathrooms', 'area'):
+            record[name] = float(request.GET.get(name))
+    except (TypeError, ValueError):
+        return JsonResponse({"Bad Request": "bedrooms, bathrooms and area should be numbers"}, status=400)
+    result = await prediction_batcher().apredict(record)
+    return JsonResponse(result, status=400 if 'errors' in result else 200)